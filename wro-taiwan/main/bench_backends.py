@@ -0,0 +1,92 @@
+import argparse
+import glob
+import os
+import statistics
+import time
+
+from inference_backends import INFERENCE_ENGINES, create_backend
+
+# 推論引擎比較：在固定的圖片集上量測各引擎的延遲，並以 PyTorch 的結果為基準檢查偵測是否一致。
+# 用法: python bench_backends.py --images ./bench_images --engines torch onnxruntime openvino --int8
+
+DEFECT_CONFIDENCE = 0.7
+IOU_THRESHOLD = 0.5
+
+def iou(a, b):
+    x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+    x2, y2 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0, x2 - x1) * max(0, y2 - y1)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+def match(reference, candidate):
+    # 同類別且 IoU 超過門檻視為同一個偵測，回傳配對成功的數量
+    matched = 0
+    used = set()
+    for class_name, _, box in reference:
+        for i, (other_name, _, other_box) in enumerate(candidate):
+            if i not in used and other_name == class_name and iou(box, other_box) >= IOU_THRESHOLD:
+                used.add(i)
+                matched += 1
+                break
+    return matched
+
+def load_images(directory):
+    import cv2
+    paths = sorted(p for ext in ("jpg", "jpeg", "png", "bmp") for p in glob.glob(os.path.join(directory, f"*.{ext}")))
+    return [(os.path.basename(p), cv2.imread(p)) for p in paths]
+
+def run_engine(backend, images, repeat):
+    latencies = []
+    detections = []
+    for _, image in images:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = backend.detect(image, DEFECT_CONFIDENCE)[0]
+            latencies.append((time.perf_counter() - started) * 1000)
+        detections.append(result)
+    return latencies, detections
+
+def main():
+    parser = argparse.ArgumentParser(description="推論引擎延遲與偵測一致性比較")
+    parser.add_argument("--model", default="best.pt")
+    parser.add_argument("--images", required=True, help="固定的測試圖片資料夾")
+    parser.add_argument("--engines", nargs="+", default=list(INFERENCE_ENGINES), choices=INFERENCE_ENGINES)
+    parser.add_argument("--int8", action="store_true", help="額外比較 INT8 量化版本 (torch 除外)")
+    parser.add_argument("--int8-data", default=None, help="OpenVINO INT8 校正用的 data yaml")
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    images = load_images(args.images)
+    if not images:
+        raise SystemExit(f"'{args.images}' 裡沒有圖片。")
+
+    variants = [(engine, False) for engine in args.engines]
+    if args.int8:
+        variants += [(engine, True) for engine in args.engines if engine != "torch"]
+
+    reference_backend = create_backend("torch", args.model, imgsz=args.imgsz).load()
+    run_engine(reference_backend, images[:1], 1)
+    _, reference = run_engine(reference_backend, images, 1)
+    reference_total = sum(len(d) for d in reference)
+    reference_verdicts = [bool(d) for d in reference]
+
+    print(f"{len(images)} 張圖片，基準 (torch) 共 {reference_total} 個偵測")
+    print(f"{'engine':>18} {'mean ms':>8} {'p50 ms':>8} {'p95 ms':>8} {'recall':>7} {'precision':>9} {'verdict':>8}")
+    for engine, int8 in variants:
+        backend = create_backend(engine, args.model, imgsz=args.imgsz, int8=int8, int8_data=args.int8_data).load()
+        # 第一次推論包含初始化，暖機後再量測
+        run_engine(backend, images[:1], 1)
+        latencies, detections = run_engine(backend, images, args.repeat)
+        matched = sum(match(ref, det) for ref, det in zip(reference, detections))
+        total = sum(len(d) for d in detections)
+        recall = matched / reference_total if reference_total else 1.0
+        precision = matched / total if total else 1.0
+        verdict_agreement = sum(bool(d) == v for d, v in zip(detections, reference_verdicts)) / len(images)
+        p95 = statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else latencies[0]
+        name = engine + (" int8" if int8 else "")
+        print(f"{name:>18} {statistics.mean(latencies):8.1f} {statistics.median(latencies):8.1f} {p95:8.1f} {recall:7.1%} {precision:9.1%} {verdict_agreement:8.1%}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import argparse
+import asyncio
+import collections
+import contextlib
+import io
+import os
+import statistics
+import time
+
+# 端對端負載測試：以 hub_sim 的模擬 Hub、合成畫面與假推論在本機跑完整的 main.py，
+# 量測 Hub 送出 INSPECT 到收到結果的延遲，以及伺服器解析封包、推播儀表板與影像串流的吞吐量。
+# 用法: python bench_e2e.py --duration 30 --inspect-interval 0.2 --storage-interval 0.01 --corrupt 0.05 --dashboards 20
+
+class DashboardSink:
+    # 代替瀏覽器的 WebSocket，只計算收到的訊息數量，可以設定每次送出的延遲模擬慢的連線
+    def __init__(self, send_delay):
+        self.send_delay = send_delay
+        self.messages = 0
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, message):
+        if self.send_delay:
+            await asyncio.sleep(self.send_delay)
+        self.messages += 1
+
+    async def close(self):
+        pass
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+async def watch_video(main, width, counter):
+    async for _ in main.get_camera(None).streamer.frames(width, main.STREAM_MAX_FPS):
+        counter[0] += 1
+
+async def run(args, report):
+    import main
+    from hub_sim import SIM_HUBS
+    async with main.lifespan(main.app):
+        await asyncio.wait_for(main.model_ready.wait(), 60)
+        if main.model_state != "ready":
+            raise SystemExit("模型載入失敗，無法進行測試。")
+        sinks = [DashboardSink(args.dashboard_delay / 1000) for _ in range(args.dashboards)]
+        for sink in sinks:
+            await main.manager.connect(sink)
+        video_frames = [0]
+        viewers = [asyncio.create_task(watch_video(main, 640, video_frames)) for _ in range(args.video_viewers)]
+        await asyncio.sleep(args.warmup)
+
+        hubs = list(SIM_HUBS.values())
+        for hub in hubs:
+            hub.reset_stats()
+        for sink in sinks:
+            sink.messages = 0
+        video_frames[0] = 0
+        decoders = [session.decoder for session in main.hub_sessions.values()]
+        packets = sum(d.packets for d in decoders)
+        resyncs = sum(d.resyncs for d in decoders)
+        garbage = sum(d.garbage_bytes for d in decoders)
+        frames = sum(main.CAMERA_FRAMES.labels(name).value for name in main.cameras)
+        started = time.perf_counter()
+        await asyncio.sleep(args.duration)
+        elapsed = time.perf_counter() - started
+
+        for viewer in viewers:
+            viewer.cancel()
+        latencies = [latency * 1000 for hub in hubs for latency in hub.inspect_latencies]
+        results = sum((hub.results for hub in hubs), collections.Counter())
+        report.append(f"--- {elapsed:.1f} 秒，{len(hubs)} 台 Hub，模式 {main.INSPECT_MODE}，推論 {os.environ['WRO_SIM_INFERENCE_MS']} ms")
+        report.append(f"INSPECT: {len(latencies)} 次 ({len(latencies) / elapsed:.2f}/s)  結果 {dict(results)}  "
+                      f"補問 {sum(hub.retries for hub in hubs)}  逾時 {sum(hub.timeouts for hub in hubs)}")
+        if latencies:
+            report.append(f"INSPECT 延遲 ms: mean {statistics.mean(latencies):.1f}  p50 {percentile(latencies, 0.5):.1f}  "
+                          f"p95 {percentile(latencies, 0.95):.1f}  p99 {percentile(latencies, 0.99):.1f}  max {max(latencies):.1f}")
+        sent = sum(sum(hub.packets_sent.values()) for hub in hubs)
+        parsed = sum(d.packets for d in decoders) - packets
+        report.append(f"Hub 封包: 送出 {sent} ({sum(hub.bytes_sent for hub in hubs) / elapsed / 1024:.1f} KB/s, "
+                      f"{sum(hub.notifications for hub in hubs)} 次通知)  解析 {parsed} ({parsed / elapsed:.0f}/s)  "
+                      f"resync {sum(d.resyncs for d in decoders) - resyncs}  雜訊 {sum(d.garbage_bytes for d in decoders) - garbage}B")
+        queued = main.BLE_WRITE_QUEUE_SECONDS.labels()
+        written = sum(queued.counts)
+        report.append(f"回寫 Hub: {written} 則，平均排隊到送完 {queued.sum / written * 1000 if written else 0:.1f} ms  "
+                      f"重試 {main.BLE_WRITE_RETRIES.labels().value}  失敗 {main.BLE_WRITE_ERRORS.labels().value}")
+        report.append(f"鏡頭: {(sum(main.CAMERA_FRAMES.labels(name).value for name in main.cameras) - frames) / elapsed / len(main.cameras):.1f} FPS (每支)")
+        if sinks:
+            received = [sink.messages for sink in sinks]
+            report.append(f"儀表板: {len(sinks)} 個連線，每個平均收到 {statistics.mean(received) / elapsed:.1f} 則/s  "
+                          f"(最少 {min(received)}，丟棄/合併 {main.WS_DROPPED.labels().value})")
+        if viewers:
+            report.append(f"影像串流: {len(viewers)} 個觀看者，共 {video_frames[0] / elapsed:.1f} 幀/s")
+        for sink in sinks:
+            main.manager.disconnect(sink)
+
+def main():
+    parser = argparse.ArgumentParser(description="以模擬 Hub 量測 main.py 端對端延遲與吞吐量")
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--hubs", type=int, default=1, help="同時模擬的 Hub (換電站) 數量")
+    parser.add_argument("--warmup", type=float, default=2.0)
+    parser.add_argument("--inspect-interval", type=float, default=0.5, help="Hub 收到結果後隔多久再送下一個 INSPECT (秒)")
+    parser.add_argument("--storage-interval", type=float, default=0.1, help="storage 封包間隔 (秒)，0 表示不送")
+    parser.add_argument("--log-interval", type=float, default=0.1, help="log 封包間隔 (秒)，0 表示不送")
+    parser.add_argument("--max-chunk", type=int, default=20, help="BLE 通知的最大片段大小")
+    parser.add_argument("--corrupt", type=float, default=0.0, help="每個封包前插入雜訊的機率")
+    parser.add_argument("--write-latency", type=float, default=10.0, help="回寫 Hub 的 BLE 延遲 (ms)")
+    parser.add_argument("--write-fail", type=float, default=0.0, help="回寫 Hub 時暫時失敗的機率")
+    parser.add_argument("--inference-ms", type=float, default=30.0)
+    parser.add_argument("--defect-rate", type=float, default=0.2)
+    parser.add_argument("--fps", type=float, default=30.0)
+    parser.add_argument("--mode", choices=("stream", "vote"), default="stream")
+    parser.add_argument("--dashboards", type=int, default=5, help="模擬的儀表板 WebSocket 連線數")
+    parser.add_argument("--dashboard-delay", type=float, default=0.0, help="每則儀表板訊息的送出延遲 (ms)")
+    parser.add_argument("--video-viewers", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true", help="顯示伺服器的輸出")
+    args = parser.parse_args()
+
+    # main 與 hub_sim 在匯入時讀取設定，必須先設定環境變數
+    os.environ.update({
+        "WRO_SIMULATE": "1",
+        "WRO_HUB_NAMES": ",".join(f"sim-{i + 1}" for i in range(args.hubs)),
+        "WRO_INFERENCE_ENGINE": "sim",
+        "WRO_INSPECT_MODE": args.mode,
+        "WRO_SIM_INSPECT_INTERVAL": str(args.inspect_interval),
+        "WRO_SIM_STORAGE_INTERVAL": str(args.storage_interval),
+        "WRO_SIM_LOG_INTERVAL": str(args.log_interval),
+        "WRO_SIM_MAX_CHUNK": str(args.max_chunk),
+        "WRO_SIM_CORRUPT": str(args.corrupt),
+        "WRO_SIM_WRITE_LATENCY": str(args.write_latency / 1000),
+        "WRO_SIM_WRITE_FAIL": str(args.write_fail),
+        "WRO_SIM_INFERENCE_MS": str(args.inference_ms),
+        "WRO_SIM_DEFECT_RATE": str(args.defect_rate),
+        "WRO_SIM_FPS": str(args.fps),
+        "WRO_SIM_SEED": str(args.seed),
+    })
+    report = []
+    # 伺服器每個封包都會 print，測試期間預設不顯示
+    with contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO()):
+        asyncio.run(run(args, report))
+    print("\n".join(report))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import argparse
+import random
+import struct
+import time
+
+from packet_decoder import PacketDecoder
+
+# handle_rx 封包解析的微基準測試：把 robot_arms.py 會送出的封包切成隨機大小的片段、
+# 插入雜訊後餵給解碼器，並與舊版 bytes += 的解析方式比較。
+# 用法: python bench_parser.py --packets 20000 --corrupt 0.05
+
+def make_packets(count, rng):
+    packets = []
+    for i in range(count):
+        kind = rng.random()
+        if kind < 0.2:
+            packets.append((0x01, struct.pack('>BBBBBB', 1, rng.randrange(101), 1, rng.randrange(101), 0, 0)))
+        elif kind < 0.5:
+            packets.append((0x02, rng.choice([b'INSPECT', b'RDY_FOR_RESULT'])))
+        else:
+            packets.append((0x03, f"debug message {i} {'x' * rng.randrange(60)}".encode()))
+    return packets
+
+def make_stream(packets, corrupt, rng):
+    stream = bytearray()
+    for packet_type, payload in packets:
+        if rng.random() < corrupt:
+            # 隨機雜訊，刻意混入 '>' 與 '<' 來觸發重新同步
+            stream += bytes(rng.choice(b'>< \x00\x01\x02abc') for _ in range(rng.randrange(1, 12)))
+        stream += b'>' + bytes([packet_type, len(payload)]) + payload + b'<'
+    return bytes(stream)
+
+def fragment(stream, max_chunk, rng):
+    chunks = []
+    pos = 0
+    while pos < len(stream):
+        size = rng.randrange(1, max_chunk + 1)
+        chunks.append(stream[pos:pos + size])
+        pos += size
+    return chunks
+
+def run_decoder(chunks):
+    decoder = PacketDecoder()
+    received = 0
+    for chunk in chunks:
+        for _, payload in decoder.feed(chunk):
+            received += len(payload)
+    return decoder.packets, decoder.resyncs, decoder.garbage_bytes
+
+def run_legacy(chunks):
+    # 舊版 handle_rx 的演算法，用來對照
+    data_buffer = b''
+    packets = 0
+    for data in chunks:
+        data_buffer += data
+        while True:
+            start_index = data_buffer.find(b'>')
+            if start_index == -1:
+                if len(data_buffer) > 1024:
+                    data_buffer = b''
+                break
+            data_buffer = data_buffer[start_index:]
+            if len(data_buffer) < 3:
+                break
+            payload_len = data_buffer[2]
+            full_packet_len = 3 + payload_len + 1
+            if len(data_buffer) < full_packet_len:
+                break
+            if data_buffer[full_packet_len - 1] != ord('<'):
+                data_buffer = data_buffer[1:]
+                continue
+            packets += 1
+            data_buffer = data_buffer[full_packet_len:]
+    return packets, None, None
+
+def bench(name, func, chunks, total_bytes, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        packets, resyncs, garbage = func(chunks)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    extra = f" resync={resyncs} garbage={garbage}B" if resyncs is not None else ""
+    print(f"{name:>8}: {best * 1000:8.2f} ms  {total_bytes / best / 1e6:7.2f} MB/s  {packets / best:10.0f} pkt/s  packets={packets}{extra}")
+
+def main():
+    parser = argparse.ArgumentParser(description="handle_rx 封包解析微基準測試")
+    parser.add_argument("--packets", type=int, default=20000)
+    parser.add_argument("--corrupt", type=float, default=0.05, help="每個封包前插入雜訊的機率")
+    parser.add_argument("--max-chunk", type=int, default=20, help="BLE 通知的最大片段大小")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    packets = make_packets(args.packets, rng)
+    for corrupt in (0.0, args.corrupt):
+        stream = make_stream(packets, corrupt, rng)
+        for max_chunk in (args.max_chunk, len(stream)):
+            chunks = fragment(stream, max_chunk, rng)
+            print(f"--- {len(stream)} bytes, {len(chunks)} chunks, corrupt={corrupt}")
+            bench("decoder", run_decoder, chunks, len(stream), args.repeat)
+            bench("legacy", run_legacy, chunks, len(stream), args.repeat)
+
+if __name__ == "__main__":
+    main()
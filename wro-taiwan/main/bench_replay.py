@@ -0,0 +1,78 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import time
+
+# 重播以 WRO_RECORD_DIR 錄下的比賽資料，把藍牙通知與鏡頭畫面重新送過 main.py 的解析、推論與推播，
+# 用來重現現場的延遲問題，並比較每次修改前後的表現。預設盡快重播，--realtime 依錄製時的節奏重播。
+# 用法: python bench_replay.py recordings/20250101-120000 --engine onnxruntime
+
+def histogram_stats(child):
+    count = sum(child.counts)
+    return count, (child.sum / count * 1000 if count else 0.0)
+
+async def run(args, report):
+    import main
+    from recorder import REPLAY
+    recorded = max(REPLAY.notifications[-1][0] if REPLAY.notifications else 0.0,
+                   float(REPLAY.frames[-1]['timestamp']) if REPLAY.frames is not None else 0.0)
+    REPLAY.running.clear()
+    async with main.lifespan(main.app):
+        await asyncio.wait_for(main.model_ready.wait(), 300)
+        if main.model_state != "ready":
+            raise SystemExit("模型載入失敗，無法重播。")
+        started = time.perf_counter()
+        REPLAY.running.set()
+        while not REPLAY.done:
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+        # 等待最後幾個 INSPECT 的結果送出
+        drain_deadline = time.monotonic() + args.drain
+        while time.monotonic() < drain_deadline and main.INSPECTIONS_IN_FLIGHT.labels().value:
+            await asyncio.sleep(0.05)
+
+        decoders = [session.decoder for session in main.hub_sessions.values()]
+        frames = len(REPLAY.frames) if REPLAY.frames is not None else 0
+        report.append(f"--- {REPLAY.directory}: 錄製 {recorded:.1f} 秒，重播 {elapsed:.1f} 秒 ({recorded / elapsed if elapsed else 0:.1f}x){' realtime' if REPLAY.realtime else ''}")
+        report.append(f"畫面: {frames} 幀 ({frames / elapsed if elapsed else 0:.1f} FPS)  藍牙通知: {len(REPLAY.notifications)}  "
+                      f"封包: {sum(d.packets for d in decoders)}  resync {sum(d.resyncs for d in decoders)}  雜訊 {sum(d.garbage_bytes for d in decoders)}B")
+        for kind in ("stream", "vote"):
+            count, mean = histogram_stats(main.INFERENCE_SECONDS.labels(kind))
+            if count:
+                report.append(f"推論 ({kind}, {main.INFERENCE_ENGINE}): {count} 次，平均 {mean:.1f} ms")
+        count, mean = histogram_stats(main.INSPECT_SECONDS.labels())
+        report.append(f"INSPECT: {count} 次，平均 {mean:.1f} ms")
+        for offset, hub, data in REPLAY.replies:
+            report.append(f"  {offset:8.2f}s  {hub}  {data[1:].decode('utf-8', errors='ignore').strip()}")
+
+def main():
+    parser = argparse.ArgumentParser(description="重播錄製的藍牙通知與鏡頭畫面")
+    parser.add_argument("session", help="WRO_RECORD_DIR 底下的錄製資料夾")
+    parser.add_argument("--realtime", action="store_true", help="依錄製時的時間間隔重播")
+    parser.add_argument("--engine", default=None, help="推論引擎 (預設沿用 WRO_INFERENCE_ENGINE)")
+    parser.add_argument("--mode", choices=("stream", "vote"), default=None)
+    parser.add_argument("--drain", type=float, default=10.0, help="重播結束後等待 INSPECT 結果的最長秒數")
+    parser.add_argument("--verbose", action="store_true", help="顯示伺服器的輸出")
+    args = parser.parse_args()
+
+    os.environ["WRO_REPLAY_DIR"] = args.session
+    os.environ["WRO_REPLAY_REALTIME"] = "1" if args.realtime else "0"
+    os.environ.pop("WRO_SIMULATE", None)
+    os.environ.pop("WRO_RECORD_DIR", None)
+    # 連線到錄製時的那幾台 Hub
+    with open(os.path.join(args.session, "session.json"), "r", encoding="utf-8") as f:
+        os.environ["WRO_HUB_NAMES"] = ",".join(json.load(f).get("hubs", []))
+    if args.engine:
+        os.environ["WRO_INFERENCE_ENGINE"] = args.engine
+    if args.mode:
+        os.environ["WRO_INSPECT_MODE"] = args.mode
+    report = []
+    with contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO()):
+        asyncio.run(run(args, report))
+    print("\n".join(report))
+
+if __name__ == "__main__":
+    main()
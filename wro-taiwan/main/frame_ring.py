@@ -0,0 +1,133 @@
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+# 預先配置 N 個影像槽的環狀緩衝區。
+# 寫入端 (鏡頭執行緒) 直接把畫面讀進空槽，讀取端以 pin 鎖住槽位而不是複製畫面；
+# 被 pin 住的槽位不會被覆寫。shared=True 時資料放在 SharedMemory 中，
+# 其他行程可以用 FrameRing.attach(ring.spec()) 直接讀取，不需要 pickle 畫面。
+
+_HEADER_ALIGN = 64
+
+class PinnedFrame:
+    def __init__(self, ring, slot, seq, timestamp):
+        self.ring = ring
+        self.slot = slot
+        self.seq = seq
+        self.timestamp = timestamp
+        self.image = ring.frames[slot]
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.ring._unpin(self.slot)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class FrameRing:
+    def __init__(self, shape, slots=4, dtype=np.uint8, shared=False, _attach=None):
+        self.shape = tuple(shape)
+        self.slots = slots
+        self.dtype = np.dtype(dtype)
+        frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        meta_bytes = slots * 8 * 3
+        frames_offset = -(-meta_bytes // _HEADER_ALIGN) * _HEADER_ALIGN
+        self._owner = _attach is None
+        self._shm = None
+        if _attach is not None:
+            shm_name, self._lock = _attach
+            self._shm = shared_memory.SharedMemory(name=shm_name)
+            buffer = self._shm.buf
+        elif shared:
+            self._shm = shared_memory.SharedMemory(create=True, size=frames_offset + slots * frame_bytes)
+            self._lock = multiprocessing.Lock()
+            buffer = self._shm.buf
+        else:
+            self._lock = threading.Lock()
+            buffer = bytearray(frames_offset + slots * frame_bytes)
+        # seq == 0 代表槽位是空的或正在寫入
+        self._seq = np.ndarray((slots,), dtype=np.int64, buffer=buffer, offset=0)
+        self._timestamp = np.ndarray((slots,), dtype=np.float64, buffer=buffer, offset=slots * 8)
+        self._pins = np.ndarray((slots,), dtype=np.int64, buffer=buffer, offset=slots * 16)
+        self.frames = np.ndarray((slots, *self.shape), dtype=self.dtype, buffer=buffer, offset=frames_offset)
+        if self._owner:
+            self._seq[:] = 0
+            self._pins[:] = 0
+
+    def spec(self):
+        if self._shm is None:
+            raise ValueError("只有 shared=True 的 FrameRing 可以跨行程共用")
+        return (self._shm.name, self._lock, self.shape, self.slots, self.dtype.str)
+
+    @classmethod
+    def attach(cls, spec):
+        shm_name, lock, shape, slots, dtype = spec
+        return cls(shape, slots, dtype, _attach=(shm_name, lock))
+
+    def close(self):
+        if self._shm is None:
+            return
+        del self._seq, self._timestamp, self._pins, self.frames
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+        self._shm = None
+
+    def begin_write(self):
+        # 選擇最舊且沒有被 pin 住的槽位，永遠保留最新的一幀給讀取端
+        with self._lock:
+            latest = int(np.argmax(self._seq))
+            best = None
+            for slot in range(self.slots):
+                if self._pins[slot] or (slot == latest and self._seq[slot]):
+                    continue
+                if best is None or self._seq[slot] < self._seq[best]:
+                    best = slot
+            if best is not None:
+                self._seq[best] = 0
+            return best
+
+    def commit(self, slot, seq, timestamp):
+        with self._lock:
+            self._timestamp[slot] = timestamp
+            self._seq[slot] = seq
+
+    def latest_seq(self):
+        return int(self._seq.max())
+
+    def _pin_slot(self, slot):
+        self._pins[slot] += 1
+        return PinnedFrame(self, slot, int(self._seq[slot]), float(self._timestamp[slot]))
+
+    def pin_latest(self):
+        with self._lock:
+            slot = int(np.argmax(self._seq))
+            if not self._seq[slot]:
+                return None
+            return self._pin_slot(slot)
+
+    def pin(self, seq):
+        with self._lock:
+            for slot in range(self.slots):
+                if self._seq[slot] == seq:
+                    return self._pin_slot(slot)
+        return None
+
+    def pin_recent(self, count, not_before=0.0):
+        # 一次 pin 住最新的 count 幀 (依 seq 由舊到新)，不足 count 幀時回傳 None
+        with self._lock:
+            slots = [slot for slot in range(self.slots) if self._seq[slot] and self._timestamp[slot] >= not_before]
+            if len(slots) < count:
+                return None
+            slots.sort(key=lambda slot: self._seq[slot])
+            return [self._pin_slot(slot) for slot in slots[-count:]]
+
+    def _unpin(self, slot):
+        with self._lock:
+            self._pins[slot] -= 1
@@ -0,0 +1,172 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+# 電池倉狀態與 INSPECT 結果的歷史紀錄 (SQLite, WAL 模式)。
+# 寫入只是把紀錄丟進佇列，由背景執行緒每次收集一批後在同一個交易內寫入，不會卡住 event loop；
+# 查詢在呼叫端的執行緒 (asyncio.to_thread) 以各自的唯讀連線執行，WAL 模式下讀寫互不阻塞。
+# 縮圖存成 JPEG 檔，資料庫只記錄檔名。
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS storage_snapshots (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    station TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS storage_station_ts ON storage_snapshots (station, ts);
+CREATE INDEX IF NOT EXISTS storage_ts ON storage_snapshots (ts);
+CREATE TABLE IF NOT EXISTS inspections (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    station TEXT NOT NULL,
+    request_id TEXT,
+    verdict TEXT NOT NULL,
+    prediction TEXT,
+    mode TEXT,
+    detections TEXT,
+    frames TEXT,
+    latency REAL,
+    thumbnail TEXT
+);
+CREATE INDEX IF NOT EXISTS inspections_station_ts ON inspections (station, ts);
+CREATE INDEX IF NOT EXISTS inspections_ts ON inspections (ts);
+"""
+
+BATCH_SIZE = 256
+BATCH_WAIT = 0.2
+THUMBNAIL_QUALITY = 70
+
+class HistoryStore:
+    def __init__(self, path, thumbnail_dir=None):
+        self.path = path
+        self.thumbnail_dir = thumbnail_dir
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if thumbnail_dir:
+            os.makedirs(thumbnail_dir, exist_ok=True)
+        self.queue = queue.Queue()
+        self.local = threading.local()
+        self.written = 0
+        self.writer = threading.Thread(target=self.write_loop, name="history-writer", daemon=True)
+        connection = sqlite3.connect(path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SCHEMA)
+        connection.close()
+        self.writer.start()
+
+    def record_storage(self, station, data):
+        self.queue.put(("storage", (time.time(), station, json.dumps(data))))
+
+    def record_inspection(self, station, inspection, request_id, verdict, latency, thumbnail=None):
+        # thumbnail 是已縮小的 BGR 畫面，在寫入執行緒才編碼成 JPEG
+        self.queue.put(("inspection", (inspection["time"], station, request_id, verdict, inspection["prediction"], inspection["mode"],
+                                       json.dumps(inspection.get("detections", [])), json.dumps(inspection["frames"]), latency), thumbnail))
+
+    def close(self):
+        self.queue.put(None)
+        self.writer.join(timeout=5)
+
+    def write_loop(self):
+        connection = sqlite3.connect(self.path)
+        # WAL 模式下 NORMAL 已能保證資料庫不會損壞，只可能在斷電時遺失最後幾筆
+        connection.execute("PRAGMA synchronous=NORMAL")
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + BATCH_WAIT
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            if None in batch:
+                running = False
+                batch = [item for item in batch if item is not None]
+            storage_rows = [item[1] for item in batch if item[0] == "storage"]
+            inspection_rows = []
+            for item in batch:
+                if item[0] != "inspection":
+                    continue
+                # 縮圖存不了 (磁碟滿、編碼失敗) 仍然寫入這筆紀錄，寫入執行緒不能因此停掉
+                try:
+                    thumbnail = self.save_thumbnail(item[1], item[2])
+                except Exception as e:
+                    print(f"儲存歷史縮圖失敗: {e}")
+                    thumbnail = None
+                inspection_rows.append(item[1] + (thumbnail,))
+            try:
+                with connection:
+                    connection.executemany("INSERT INTO storage_snapshots (ts, station, data) VALUES (?, ?, ?)", storage_rows)
+                    connection.executemany("INSERT INTO inspections (ts, station, request_id, verdict, prediction, mode, detections, frames, latency, thumbnail) "
+                                           "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", inspection_rows)
+                self.written += len(batch)
+            except sqlite3.Error as e:
+                print(f"寫入歷史紀錄失敗 ({len(batch)} 筆): {e}")
+        connection.close()
+
+    def save_thumbnail(self, row, thumbnail):
+        if thumbnail is None or not self.thumbnail_dir:
+            return None
+        import cv2
+        ts, station, request_id = row[0], row[1], row[2]
+        name = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(ts))}-{int(ts * 1000) % 1000:03d}-{station}-{request_id or 'x'}.jpg"
+        name = "".join(c if c.isalnum() or c in "-_." else "_" for c in name)
+        ok, encoded = cv2.imencode('.jpg', thumbnail, [cv2.IMWRITE_JPEG_QUALITY, THUMBNAIL_QUALITY])
+        if not ok:
+            return None
+        with open(os.path.join(self.thumbnail_dir, name), "wb") as f:
+            f.write(encoded.tobytes())
+        return name
+
+    def reader(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            connection.row_factory = sqlite3.Row
+            self.local.connection = connection
+        return connection
+
+    def query(self, table, station=None, since=None, until=None, before_id=None, limit=100):
+        # 以 id 由新到舊分頁：下一頁帶入上一頁回傳的 next_before_id
+        clauses, params = [], []
+        for clause, value in (("station = ?", station), ("ts >= ?", since), ("ts < ?", until), ("id < ?", before_id)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = self.reader().execute(f"SELECT * FROM {table} {where} ORDER BY id DESC LIMIT ?", params + [limit]).fetchall()
+        items = []
+        for row in rows:
+            item = dict(row)
+            for key in ("data", "detections", "frames"):
+                if item.get(key) is not None:
+                    item[key] = json.loads(item[key])
+            items.append(item)
+        return {"items": items, "next_before_id": items[-1]["id"] if len(items) == limit else None}
+
+    def inspections(self, **filters):
+        return self.query("inspections", **filters)
+
+    def storage_snapshots(self, **filters):
+        return self.query("storage_snapshots", **filters)
+
+    def defect_rate(self, station=None, since=None, until=None, bucket=3600):
+        clauses, params = [], []
+        for clause, value in (("station = ?", station), ("ts >= ?", since), ("ts < ?", until)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = self.reader().execute(
+            f"SELECT CAST(ts / ? AS INTEGER) * ? AS bucket_start, COUNT(*) AS total, "
+            f"SUM(verdict = 'DIRTY') AS defects, SUM(prediction = 'error') AS errors, AVG(latency) AS mean_latency "
+            f"FROM inspections {where} GROUP BY bucket_start ORDER BY bucket_start", [bucket, bucket] + params).fetchall()
+        return [dict(row, rate=row["defects"] / row["total"]) for row in rows]
+
+    def last_storage(self, station):
+        row = self.reader().execute("SELECT data FROM storage_snapshots WHERE station = ? ORDER BY id DESC LIMIT 1", (station,)).fetchone()
+        return json.loads(row["data"]) if row else None
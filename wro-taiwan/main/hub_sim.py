@@ -0,0 +1,299 @@
+import asyncio
+import collections
+import os
+import random
+import struct
+import time
+
+from inference_backends import InferenceBackend
+
+# 本機模擬器：不需要實體 Spike Hub 與鏡頭就能跑 main.py。
+# SimulatedScanner / SimulatedClient 取代 BleakScanner / BleakClient，每個要求的 Hub 名稱各模擬一台 robot_arms.py，送出
+# `>` type len payload `<` 封包 (INSPECT、RDY_FOR_RESULT、storage、log)，可調整頻率、BLE 分段大小與雜訊；
+# SyntheticCapture 取代 cv2.VideoCapture(0)，SimulatedBackend 以固定延遲代替 YOLO 推論。
+# 用法: WRO_SIMULATE=1 WRO_INFERENCE_ENGINE=sim python main.py
+
+PACKET_TYPE_STORAGE = 0x01
+PACKET_TYPE_COMMAND = 0x02
+PACKET_TYPE_LOG = 0x03
+PACKET_TYPE_STATS = 0x04
+# Pybricks 協定：Hub 的 stdout 以 0x01 事件送出，PC 寫入 stdin 的指令開頭為 0x06
+PYBRICKS_EVENT_WRITE_STDOUT = 0x01
+PYBRICKS_COMMAND_WRITE_STDIN = 0x06
+
+def env_float(name, default):
+    return float(os.environ.get(name, default))
+
+class SimulatedDevice:
+    def __init__(self, name, address="00:00:00:00:00:00"):
+        self.name = name
+        self.address = address
+
+class SimulatedHub:
+    def __init__(self, name="handsome", inspect_interval=3.0, storage_interval=1.0, log_interval=0.5,
+                 max_chunk=20, corrupt=0.0, write_latency=0.01, write_fail=0.0, mtu=23, reply_timeout=10.0, retry_interval=2.0, seed=None):
+        self.device = SimulatedDevice(name)
+        self.inspect_interval = inspect_interval
+        self.storage_interval = storage_interval
+        self.log_interval = log_interval
+        self.max_chunk = max_chunk
+        self.corrupt = corrupt
+        self.write_latency = write_latency
+        self.write_fail = write_fail
+        self.mtu = mtu
+        self.reply_timeout = reply_timeout
+        self.retry_interval = retry_interval
+        self.rng = random.Random(seed)
+        self.notify = None
+        self.stdin = bytearray()
+        self.replies = {}
+        self.request_id = 0
+        self.reset_stats()
+
+    @classmethod
+    def from_env(cls, name, index=0):
+        seed = os.environ.get("WRO_SIM_SEED")
+        return cls(
+            name=name,
+            inspect_interval=env_float("WRO_SIM_INSPECT_INTERVAL", "3.0"),
+            storage_interval=env_float("WRO_SIM_STORAGE_INTERVAL", "1.0"),
+            log_interval=env_float("WRO_SIM_LOG_INTERVAL", "0.5"),
+            max_chunk=int(os.environ.get("WRO_SIM_MAX_CHUNK", "20")),
+            corrupt=env_float("WRO_SIM_CORRUPT", "0.0"),
+            write_latency=env_float("WRO_SIM_WRITE_LATENCY", "0.01"),
+            write_fail=env_float("WRO_SIM_WRITE_FAIL", "0.0"),
+            mtu=int(os.environ.get("WRO_SIM_MTU", "23")),
+            seed=int(seed) + index if seed else None,
+        )
+
+    def reset_stats(self):
+        self.packets_sent = collections.Counter()
+        self.bytes_sent = 0
+        self.notifications = 0
+        self.inspect_latencies = []
+        self.results = collections.Counter()
+        self.retries = 0
+        self.timeouts = 0
+
+    def send_packet(self, packet_type, payload):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        stream = bytearray()
+        if self.corrupt and self.rng.random() < self.corrupt:
+            # 刻意混入 '>' 與 '<' 的雜訊，觸發 PC 端解碼器重新同步
+            stream += bytes(self.rng.choice(b'>< \x00\x01\x02abc') for _ in range(self.rng.randrange(1, 12)))
+        stream += b'>' + bytes([packet_type, len(payload)]) + payload + b'<'
+        self.packets_sent[packet_type] += 1
+        self.bytes_sent += len(stream)
+        pos = 0
+        while pos < len(stream) and self.notify is not None:
+            size = self.rng.randrange(1, self.max_chunk + 1)
+            self.notify(None, bytearray([PYBRICKS_EVENT_WRITE_STDOUT]) + stream[pos:pos + size])
+            self.notifications += 1
+            pos += size
+
+    def on_write(self, data):
+        if not data or data[0] != PYBRICKS_COMMAND_WRITE_STDIN:
+            return
+        self.stdin += data[1:]
+        while b'\n' in self.stdin:
+            line, _, rest = bytes(self.stdin).partition(b'\n')
+            self.stdin = bytearray(rest)
+            reply_id, _, result = line.decode('utf-8', errors='ignore').strip().partition(':')
+            waiter = self.replies.get(reply_id)
+            if waiter is not None and result and not waiter.done():
+                waiter.set_result(result)
+
+    async def inspect_once(self):
+        # 與 robot_arms.wait_for_ai_result 相同：送出 INSPECT:<id>，逾時前每隔一段時間補問 RDY_FOR_RESULT:<id>
+        self.request_id = self.request_id % 999 + 1
+        request_id = str(self.request_id)
+        waiter = asyncio.get_running_loop().create_future()
+        self.replies[request_id] = waiter
+        started = time.perf_counter()
+        self.send_packet(PACKET_TYPE_COMMAND, 'INSPECT:' + request_id)
+        try:
+            while True:
+                remaining = self.reply_timeout - (time.perf_counter() - started)
+                if remaining <= 0:
+                    self.timeouts += 1
+                    return "TIMEOUT"
+                try:
+                    result = await asyncio.wait_for(asyncio.shield(waiter), min(self.retry_interval, remaining))
+                    break
+                except asyncio.TimeoutError:
+                    self.retries += 1
+                    self.send_packet(PACKET_TYPE_COMMAND, 'RDY_FOR_RESULT:' + request_id)
+        finally:
+            del self.replies[request_id]
+        self.inspect_latencies.append(time.perf_counter() - started)
+        self.results[result] += 1
+        return result
+
+    async def inspect_loop(self):
+        # 每個 INSPECT 當作連續模式的一輪，像 robot_arms 一樣回報完成數與耗時
+        started = cycle_started = time.perf_counter()
+        cycles = 0
+        while True:
+            await self.inspect_once()
+            await asyncio.sleep(self.inspect_interval)
+            now = time.perf_counter()
+            cycles += 1
+            self.send_packet(PACKET_TYPE_STATS, struct.pack('>HII', cycles % 65536, int((now - cycle_started) * 1000), int((now - started) * 1000)))
+            cycle_started = now
+
+    async def storage_loop(self):
+        while True:
+            slots = []
+            for _ in range(3):
+                has_battery = self.rng.randrange(2)
+                slots += [has_battery, self.rng.randrange(101) if has_battery else 0]
+            self.send_packet(PACKET_TYPE_STORAGE, struct.pack('>BBBBBB', *slots))
+            await asyncio.sleep(self.storage_interval)
+
+    async def log_loop(self):
+        count = 0
+        while True:
+            count += 1
+            self.send_packet(PACKET_TYPE_LOG, f"sim log {count}")
+            await asyncio.sleep(self.log_interval)
+
+    async def run(self):
+        loops = [self.inspect_loop()]
+        if self.storage_interval > 0:
+            loops.append(self.storage_loop())
+        if self.log_interval > 0:
+            loops.append(self.log_loop())
+        await asyncio.gather(*loops)
+
+# 模擬的 Hub，依名稱在第一次被掃描到時建立
+SIM_HUBS = {}
+
+def sim_hub(name):
+    if name not in SIM_HUBS:
+        SIM_HUBS[name] = SimulatedHub.from_env(name, len(SIM_HUBS))
+    return SIM_HUBS[name]
+
+class SimulatedScanner:
+    @staticmethod
+    async def find_device_by_name(name, timeout=5.0):
+        await asyncio.sleep(0)
+        return sim_hub(name).device
+
+class SimulatedClient:
+    def __init__(self, device):
+        self.device = device
+        self.hub = sim_hub(device.name)
+        self.connected = False
+        self.task = None
+
+    @property
+    def is_connected(self):
+        return self.connected
+
+    @property
+    def mtu_size(self):
+        return self.hub.mtu
+
+    async def __aenter__(self):
+        self.connected = True
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.connected = False
+        self.hub.notify = None
+        if self.task is not None:
+            self.task.cancel()
+
+    async def start_notify(self, char_uuid, callback):
+        self.hub.notify = callback
+        self.task = asyncio.create_task(self.hub.run())
+
+    async def write_gatt_char(self, char_uuid, data, response=False):
+        if not self.connected:
+            raise ConnectionError("simulated hub disconnected")
+        if len(data) > self.hub.mtu - 3:
+            raise ValueError(f"write of {len(data)} bytes exceeds MTU {self.hub.mtu}")
+        await asyncio.sleep(self.hub.write_latency)
+        if self.hub.write_fail and self.hub.rng.random() < self.hub.write_fail:
+            # 模擬暫時性的 GATT 寫入錯誤
+            raise OSError("simulated GATT write error")
+        self.hub.on_write(bytes(data))
+
+class SyntheticCapture:
+    # 介面與 cv2.VideoCapture 相同 (isOpened / read / grab / release)，依設定的 FPS 產生移動的色塊畫面
+    def __init__(self, width=640, height=480, fps=30.0):
+        import numpy as np
+        self.np = np
+        self.shape = (height, width, 3)
+        self.interval = 1.0 / fps if fps > 0 else 0.0
+        self.next_frame = time.perf_counter()
+        self.count = 0
+        self.opened = True
+        self.background = np.tile(np.linspace(40, 200, width, dtype=np.uint8)[None, :, None], (height, 1, 3))
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            width=int(os.environ.get("WRO_SIM_FRAME_WIDTH", "640")),
+            height=int(os.environ.get("WRO_SIM_FRAME_HEIGHT", "480")),
+            fps=env_float("WRO_SIM_FPS", "30"),
+        )
+
+    def isOpened(self):
+        return self.opened
+
+    def grab(self):
+        self.read()
+        return self.opened
+
+    def read(self, image=None):
+        if not self.opened:
+            return False, None
+        delay = self.next_frame - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        self.next_frame = max(self.next_frame + self.interval, time.perf_counter() - self.interval)
+        if image is None or image.shape != self.shape:
+            image = self.np.empty(self.shape, dtype=self.np.uint8)
+        self.np.copyto(image, self.background)
+        height, width = self.shape[:2]
+        x = (self.count * 8) % max(1, width - 120)
+        image[height // 3:height // 3 + 120, x:x + 120] = (30, 160, 230)
+        self.count += 1
+        return True, image
+
+    def release(self):
+        self.opened = False
+
+class SimulatedBackend(InferenceBackend):
+    # 不載入任何模型，以固定延遲回傳結果；WRO_SIM_DEFECT_RATE 控制每一幀出現瑕疵的機率
+    engine = "sim"
+
+    def __init__(self, model_path, imgsz=640, int8=False, int8_data=None):
+        super().__init__(model_path, imgsz, int8, int8_data)
+        self.latency = env_float("WRO_SIM_INFERENCE_MS", "30") / 1000
+        self.defect_rate = env_float("WRO_SIM_DEFECT_RATE", "0.2")
+        # 和模擬 Hub 共用 WRO_SIM_SEED，固定種子時每次執行的瑕疵判定順序相同
+        seed = os.environ.get("WRO_SIM_SEED")
+        self.rng = random.Random(int(seed) if seed else None)
+
+    @property
+    def names(self):
+        return {0: "hole", 1: "line"}
+
+    def load(self):
+        return self
+
+    def predict(self, frames, imgsz=None):
+        count = len(frames) if isinstance(frames, list) else 1
+        # 批次推論比逐張便宜，延遲大致以 1 + 0.3 * (N - 1) 成長
+        time.sleep(self.latency * (1 + 0.3 * (count - 1)))
+        return [None] * count
+
+    def detect(self, frames, min_confidence, imgsz=None):
+        detections = []
+        for _ in self.predict(frames, imgsz):
+            confidence = 0.9 if self.rng.random() < self.defect_rate else 0.0
+            detections.append([(self.names[0], confidence, (100, 100, 200, 200))] if confidence > min_confidence else [])
+        return detections
@@ -0,0 +1,111 @@
+import hashlib
+import os
+import shutil
+
+# 可切換的推論引擎。torch 直接跑 best.pt；onnxruntime / openvino 會先把模型匯出並快取在
+# 模型旁的 .engine_cache 目錄，之後再透過 Ultralytics 的 AutoBackend 以對應的 runtime 執行，
+# 前後處理與輸出格式 (Results) 和 PyTorch 版完全相同。
+
+INFERENCE_ENGINES = ("torch", "onnxruntime", "openvino")
+
+class InferenceBackend:
+    engine = None
+    # 需要先匯出成其他格式的引擎設為 True 並實作 export(target)
+    needs_export = False
+
+    def __init__(self, model_path, imgsz=640, int8=False, int8_data=None):
+        self.model_path = model_path
+        self.imgsz = imgsz
+        self.int8 = int8
+        self.int8_data = int8_data
+        self.model = None
+
+    @property
+    def names(self):
+        return self.model.names
+
+    def cache_dir(self):
+        with open(self.model_path, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()[:12]
+        stem = os.path.splitext(os.path.basename(self.model_path))[0]
+        variant = f"{stem}-{self.engine}-{self.imgsz}{'-int8' if self.int8 else ''}-{digest}"
+        return os.path.join(os.path.dirname(os.path.abspath(self.model_path)), ".engine_cache", variant)
+
+    def artifact_path(self):
+        return self.model_path
+
+    def load(self):
+        from ultralytics import YOLO
+        path = self.artifact_path()
+        if not os.path.exists(path):
+            if not self.needs_export:
+                # 直接讀原始模型的引擎沒有匯出步驟，找不到就是模型檔不存在
+                raise FileNotFoundError(f"找不到模型 '{path}'")
+            print(f"[{self.engine}] 找不到快取的模型，正在從 '{self.model_path}' 匯出...")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.export(path)
+        self.model = YOLO(path, task="detect")
+        return self
+
+    def predict(self, frames, imgsz=None):
+        return self.model(frames, imgsz=imgsz or self.imgsz, verbose=False)
+
+    def detect(self, frames, min_confidence, imgsz=None):
+        # 回傳每一幀的 [(class_name, confidence, (x1, y1, x2, y2)), ...]
+        detections = []
+        for result in self.predict(frames, imgsz):
+            boxes = result.boxes
+            frame_detections = []
+            for confidence, class_id, xyxy in zip(boxes.conf.tolist(), boxes.cls.tolist(), boxes.xyxy.tolist()):
+                if confidence > min_confidence:
+                    x1, y1, x2, y2 = map(int, xyxy)
+                    frame_detections.append((self.names[int(class_id)], confidence, (x1, y1, x2, y2)))
+            detections.append(frame_detections)
+        return detections
+
+class TorchBackend(InferenceBackend):
+    engine = "torch"
+
+class OnnxRuntimeBackend(InferenceBackend):
+    engine = "onnxruntime"
+    needs_export = True
+
+    def artifact_path(self):
+        return os.path.join(self.cache_dir(), "model.onnx")
+
+    def export(self, target):
+        from ultralytics import YOLO
+        exported = YOLO(self.model_path).export(format="onnx", imgsz=self.imgsz, dynamic=True, simplify=True)
+        if self.int8:
+            # ONNX Runtime 的動態量化不需要校正資料，權重轉成 INT8
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            quantize_dynamic(exported, target, weight_type=QuantType.QUInt8)
+            os.remove(exported)
+        else:
+            shutil.move(exported, target)
+
+class OpenVinoBackend(InferenceBackend):
+    engine = "openvino"
+    needs_export = True
+
+    def artifact_path(self):
+        # Ultralytics 以資料夾名稱結尾 _openvino_model 判斷模型格式
+        return os.path.join(self.cache_dir(), "model_openvino_model")
+
+    def export(self, target):
+        from ultralytics import YOLO
+        options = {"format": "openvino", "imgsz": self.imgsz, "dynamic": True}
+        if self.int8:
+            # OpenVINO 的 INT8 需要校正資料集 (Ultralytics 的 data yaml)
+            options["int8"] = True
+            if self.int8_data:
+                options["data"] = self.int8_data
+        exported = YOLO(self.model_path).export(**options)
+        shutil.move(exported, target)
+
+BACKENDS = {backend.engine: backend for backend in (TorchBackend, OnnxRuntimeBackend, OpenVinoBackend)}
+
+def create_backend(engine, model_path, imgsz=640, int8=False, int8_data=None):
+    if engine not in BACKENDS:
+        raise ValueError(f"未知的推論引擎 '{engine}'，可用的引擎: {', '.join(INFERENCE_ENGINES)}")
+    return BACKENDS[engine](model_path, imgsz=imgsz, int8=int8, int8_data=int8_data)
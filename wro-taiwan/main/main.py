@@ -1,263 +1,1238 @@
 import asyncio
+import collections
+import gzip
+import hashlib
+import os
 import struct
 import json
 import threading
-import cv2
-import torch
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse
-from bleak import BleakScanner, BleakClient
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, Response, StreamingResponse
+# WRO_SIMULATE=1 時以 hub_sim 的模擬 Hub 與合成畫面取代藍牙和鏡頭，方便在一般電腦上測試
+SIMULATE = os.environ.get("WRO_SIMULATE", "0") == "1"
+# WRO_RECORD_DIR 錄製藍牙通知與鏡頭畫面；WRO_REPLAY_DIR 以錄製的資料夾取代藍牙和鏡頭重播
+RECORD_DIR = os.environ.get("WRO_RECORD_DIR")
+REPLAY_DIR = os.environ.get("WRO_REPLAY_DIR")
+if SIMULATE:
+    from hub_sim import SimulatedScanner as BleakScanner, SimulatedClient as BleakClient
+elif REPLAY_DIR:
+    from recorder import ReplayScanner as BleakScanner, ReplayClient as BleakClient
+else:
+    from bleak import BleakScanner, BleakClient
 from contextlib import asynccontextmanager
-from ultralytics import YOLO
+from packet_decoder import PacketDecoder
+from metrics import REGISTRY, Counter, Gauge, Histogram
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 PACKET_TYPE_STORAGE = 0x01
 PACKET_TYPE_COMMAND = 0x02
 PACKET_TYPE_LOG = 0x03
-data_buffer = b''
+PACKET_TYPE_STATS = 0x04
+# 連續模式下手臂 Hub 每完成一顆電池送一次: 完成數、這一輪的 ms、連續模式開始後經過的 ms
+CYCLE_STATS_FORMAT = '>HII'
 MODEL_PATH = "best.pt"
 CLASS_NAMES = ['hole', 'line']
 model = None
-latest_frame = None
-frame_lock = threading.Lock()
-ai_result_to_send = None
-ai_result_lock = threading.Lock()
-HUB_NAME = "handsome"
+# 模型在背景載入並暖機，狀態為 loading / ready / failed；INSPECT 會等到 ready 為止
+model_state = "loading"
+model_ready = asyncio.Event()
+MODEL_READY_TIMEOUT = float(os.environ.get("WRO_MODEL_READY_TIMEOUT", "30.0"))
+# 推論引擎: torch / onnxruntime / openvino，非 torch 的引擎第一次啟動時會匯出並快取模型
+INFERENCE_ENGINE = os.environ.get("WRO_INFERENCE_ENGINE", "torch")
+INFERENCE_IMGSZ = int(os.environ.get("WRO_INFERENCE_IMGSZ", "640"))
+INFERENCE_INT8 = os.environ.get("WRO_INFERENCE_INT8", "0") == "1"
+INFERENCE_INT8_DATA = os.environ.get("WRO_INFERENCE_INT8_DATA")
+# 電池檢查區域 "x,y,w,h"：設定後只把這塊裁切下來、以較小的 imgsz 推論，可由 /api/roi 調整並存檔
+INSPECT_ROI_FILE = os.environ.get("WRO_INSPECT_ROI_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "inspect_roi.json"))
+INSPECT_ROI_IMGSZ = int(os.environ.get("WRO_INSPECT_ROI_IMGSZ", "320"))
+inspect_roi = None
+roi_letterbox = None
+# 電池倉狀態與 INSPECT 結果的歷史資料庫 (SQLite)，設為空字串則不記錄；縮圖預設放在資料庫旁邊，不會被當成靜態檔案
+HISTORY_DB = os.environ.get("WRO_HISTORY_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "history.db"))
+HISTORY_THUMBNAIL_DIR = os.environ.get("WRO_HISTORY_THUMBNAIL_DIR", os.path.join(os.path.dirname(os.path.abspath(HISTORY_DB or __file__)), "history_thumbnails"))
+HISTORY_THUMBNAIL_WIDTH = int(os.environ.get("WRO_HISTORY_THUMBNAIL_WIDTH", "160"))
+history = None
+DEFECT_CONFIDENCE = 0.7
+INSPECTION_VERDICTS_KEEP = 16
+# 要連線的 Hub 名稱，以逗號分隔，每一台 Hub 代表一個換電站
+HUB_NAMES = [name.strip() for name in os.environ.get("WRO_HUB_NAMES", "handsome").split(",") if name.strip()]
 PYBRICKS_UNIVERSAL_CHAR_UUID = "c5f50002-8280-46da-89f4-6d8051e4aeef"
-hub_client = None
+# 這個特徵值的通知第一個位元組是事件碼，0x01 才是 Hub 程式的 stdout，其他 (例如 0x00 狀態回報) 不是封包資料
+PYBRICKS_EVENT_WRITE_STDOUT = 0x01
+PYBRICKS_COMMAND_WRITE_STDIN = 0x06
+# 回應 Hub 的寫入佇列：每台 Hub 一個，斷線期間保留，太舊的訊息 (Hub 早已逾時) 直接丟掉
+HUB_WRITE_QUEUE_SIZE = int(os.environ.get("WRO_HUB_WRITE_QUEUE_SIZE", "16"))
+HUB_WRITE_RETRIES = int(os.environ.get("WRO_HUB_WRITE_RETRIES", "3"))
+HUB_WRITE_BACKOFF = float(os.environ.get("WRO_HUB_WRITE_BACKOFF", "0.05"))
+HUB_WRITE_MAX_AGE = float(os.environ.get("WRO_HUB_WRITE_MAX_AGE", "15.0"))
+# 同時進行中的推論數量上限，推論在獨立的執行緒池中執行，不會卡住 event loop
+# 大於 1 時每個推論執行緒各載入一份模型 (記憶體也是 N 倍)，模型物件不保證能被多個執行緒同時呼叫
+INFERENCE_MAX_IN_FLIGHT = int(os.environ.get("WRO_INFERENCE_MAX_IN_FLIGHT", "1"))
+inference_executor = ThreadPoolExecutor(max_workers=INFERENCE_MAX_IN_FLIGHT, thread_name_prefix="inference")
+inference_local = threading.local()
+# INSPECT 直接取用鏡頭串流的辨識結果：預設只接受收到請求之後拍的畫面 (手臂送出 INSPECT 時已經停好)，
+# 設為大於 0 可以接受收到請求前幾秒拍的畫面，回覆較快但可能拍到還在移動中的電池
+INSPECT_MAX_RESULT_AGE = float(os.environ.get("WRO_INSPECT_MAX_RESULT_AGE", "0.0"))
+INSPECT_WAIT_TIMEOUT = float(os.environ.get("WRO_INSPECT_WAIT_TIMEOUT", "5.0"))
+# INSPECT 模式: stream 取串流中最新的結果；vote 取最近 K 幀一次批次推論再投票，較不受手臂剛停下的晃動影響
+# 投票方式: majority 為超過半數的幀偵測到該瑕疵；confidence 為各幀信心值平均超過門檻
+INSPECT_MODE = os.environ.get("WRO_INSPECT_MODE", "stream")
+INSPECT_VOTE_FRAMES = int(os.environ.get("WRO_INSPECT_VOTE_FRAMES", "5"))
+INSPECT_VOTE_POLICY = os.environ.get("WRO_INSPECT_VOTE_POLICY", "majority")
+INSPECT_VOTE_THRESHOLD = float(os.environ.get("WRO_INSPECT_VOTE_THRESHOLD", "0.5"))
+VOTE_MIN_CONFIDENCE = 0.25
+last_inspection = None
+
+@dataclass
+class HubWrite:
+    key: str | None
+    data: bytes
+    done: asyncio.Future
+    queued_at: float
+    offset: int = 0  # 已送出的位元組數，斷線重送時從這裡繼續
+
+@dataclass
+class DetectionResult:
+    seq: int
+    timestamp: float
+    detections: list = field(default_factory=list)  # [(class_name, confidence, (x1, y1, x2, y2)), ...]
+    error: str | None = None
+
+# 鏡頭畫面的環狀緩衝區，槽位數至少要比同時 pin 住的畫面數多 2
+FRAME_RING_SLOTS = int(os.environ.get("WRO_FRAME_RING_SLOTS", "4"))
+# 每個換電站各自的鏡頭，以逗號分隔、順序與 WRO_HUB_NAMES 相同；數字是 cv2 的裝置編號，其他視為影片檔或串流網址
+# 鏡頭比 Hub 少時拒絕啟動，不能讓兩個換電站用同一支鏡頭的畫面判定電池。錄製與重播只處理第一個換電站的鏡頭
+CAMERA_SOURCES = [source.strip() for source in os.environ.get("WRO_CAMERA_SOURCES", "0").split(",") if source.strip()]
+# 預設不開本機視窗 (伺服器可以 headless 執行)，畫面改由 /stream.mjpg 與 /ws/video 提供
+PREVIEW_WINDOW = os.environ.get("WRO_PREVIEW_WINDOW", "0") == "1"
+STREAM_MAX_FPS = float(os.environ.get("WRO_STREAM_MAX_FPS", "15"))
+STREAM_JPEG_QUALITY = int(os.environ.get("WRO_STREAM_JPEG_QUALITY", "80"))
+# 每個儀表板連線各自的送出佇列長度與單次送出逾時，跟不上的連線會被丟掉舊訊息或直接斷開
+WS_CLIENT_QUEUE_SIZE = int(os.environ.get("WRO_WS_CLIENT_QUEUE_SIZE", "32"))
+WS_SEND_TIMEOUT = float(os.environ.get("WRO_WS_SEND_TIMEOUT", "5.0"))
+# 儀表板靜態檔案的目錄，啟動時一次讀進記憶體並預先壓縮；開發時可設定 WRO_STATIC_RELOAD=1 自動重新載入
+# 只提供 STATIC_FILES 與 STATIC_SUBDIR 子目錄底下的檔案，同目錄的 inspect_roi.json、程式產生的圖片等不會被送出去
+STATIC_DIR = os.environ.get("WRO_STATIC_DIR", os.path.dirname(os.path.abspath(__file__)))
+STATIC_FILES = ("index.html",)
+STATIC_SUBDIR = "static"
+STATIC_RELOAD = os.environ.get("WRO_STATIC_RELOAD", "0") == "1"
+STATIC_MEDIA_TYPES = {
+    ".html": "text/html; charset=utf-8",
+    ".js": "text/javascript; charset=utf-8",
+    ".css": "text/css; charset=utf-8",
+    ".json": "application/json",
+    ".svg": "image/svg+xml",
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".ico": "image/x-icon",
+}
+main_loop = None
+# 關閉時通知鏡頭執行緒停止，要先等它們結束才能關閉推論執行緒池與環狀緩衝區
+camera_stop = threading.Event()
+CAMERA_STOP_TIMEOUT = 5.0
+session_recorder = None
+
+# Prometheus 指標，由 /metrics 輸出
+CAMERA_FRAMES = Counter("wro_camera_frames_total", "Frames captured from the camera", ["station"])
+CAMERA_FPS = Gauge("wro_camera_fps", "Capture frame rate over the last second", ["station"])
+CAMERA_READ_SECONDS = Histogram("wro_camera_read_seconds", "Time spent in cap.read()")
+INFERENCE_SECONDS = Histogram("wro_inference_seconds", "Model inference latency", ["kind"])
+INSPECT_SECONDS = Histogram("wro_inspect_seconds", "INSPECT packet received to verdict written to the hub")
+INSPECTIONS = Counter("wro_inspections_total", "Inspection verdicts sent to the hub", ["verdict"])
+INSPECTIONS_IN_FLIGHT = Gauge("wro_inspections_in_flight", "INSPECT requests still waiting for a verdict")
+ARM_CYCLES = Counter("wro_arm_cycles_total", "Battery cycles completed by the arm hubs in continuous mode")
+ARM_CYCLE_SECONDS = Histogram("wro_arm_cycle_seconds", "Duration of one battery cycle reported by the arm hub")
+Gauge("wro_arm_batteries_per_hour", "Throughput of all arm hubs since continuous mode started",
+      func=lambda: sum(s.cycle_stats["per_hour"] for s in hub_sessions.values() if s.cycle_stats))
+Gauge("wro_model_ready", "1 when the model is loaded and warmed up", func=lambda: int(model_state == "ready"))
+Counter("wro_parser_packets_total", "Packets decoded from hub notifications", func=lambda: sum(s.decoder.packets for s in hub_sessions.values()))
+Counter("wro_parser_resyncs_total", "Parser resynchronisations after a bad packet end", func=lambda: sum(s.decoder.resyncs for s in hub_sessions.values()))
+Counter("wro_parser_garbage_bytes_total", "Bytes skipped by the packet parser", func=lambda: sum(s.decoder.garbage_bytes for s in hub_sessions.values()))
+BLE_RECONNECTS = Counter("wro_ble_reconnects_total", "Hub connections established after the first one")
+Gauge("wro_ble_connected", "Number of connected hubs", func=lambda: sum(s.connected for s in hub_sessions.values()))
+BLE_WRITE_SECONDS = Histogram("wro_ble_write_seconds", "write_gatt_char latency for one hub response chunk")
+BLE_WRITE_QUEUE_SECONDS = Histogram("wro_ble_write_queue_seconds", "Hub response queued to fully written")
+BLE_WRITE_ERRORS = Counter("wro_ble_write_errors_total", "Hub responses that failed after all retries")
+BLE_WRITE_RETRIES = Counter("wro_ble_write_retries_total", "Retried hub response chunks")
+BLE_WRITES_DROPPED = Counter("wro_ble_writes_dropped_total", "Hub responses dropped before being written", ["reason"])
+Gauge("wro_ble_write_queue_depth", "Hub responses waiting to be written", func=lambda: sum(len(s.write_queue) for s in hub_sessions.values()))
+BROADCAST_SECONDS = Histogram("wro_ws_broadcast_seconds", "Time to serialize and enqueue one dashboard broadcast")
+WS_DROPPED = Counter("wro_ws_dropped_messages_total", "Dashboard messages dropped or coalesced for slow clients")
+Gauge("wro_ws_clients", "Connected dashboard WebSocket clients", func=lambda: len(manager.active_connections))
+Gauge("wro_ws_queue_depth", "Messages waiting in all dashboard client queues", func=lambda: sum(len(c.queue) for c in list(manager.active_connections.values())))
+Gauge("wro_ws_queue_depth_max", "Deepest dashboard client queue", func=lambda: max((len(c.queue) for c in list(manager.active_connections.values())), default=0))
+Gauge("wro_video_viewers", "Open MJPEG/WebSocket video streams", func=lambda: sum(sum(camera.streamer.viewers.values()) for camera in cameras.values()))
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global model
+    global main_loop, session_recorder
     print("--- 應用程式啟動中 ---")
-    try:
-        model = YOLO(MODEL_PATH)
-        print(f"成功透過 Ultralytics 從 '{MODEL_PATH}' 載入模型。")
-    except Exception as e:
-        print(f"使用 Ultralytics 載入模型失敗: {e}")
-        model = None
-    bluetooth_task_instance = asyncio.create_task(bluetooth_task())
-    cam_thread = threading.Thread(target=camera_thread_func, daemon=True)
-    cam_thread.start()
+    missing = [camera.station for camera in cameras.values() if camera.source is None]
+    if missing and not SIMULATE and not REPLAY_DIR:
+        raise RuntimeError(f"換電站 {', '.join(missing)} 沒有設定鏡頭，請在 WRO_CAMERA_SOURCES 為每台 Hub 各指定一支鏡頭。")
+    main_loop = asyncio.get_running_loop()
+    if RECORD_DIR:
+        from recorder import SessionRecorder
+        session_recorder = SessionRecorder.create(RECORD_DIR, {"hubs": HUB_NAMES, "inspect_mode": INSPECT_MODE, "engine": INFERENCE_ENGINE})
+        print(f"正在錄製藍牙通知與鏡頭畫面至 '{session_recorder.directory}'。")
+    await asyncio.to_thread(load_inspect_roi)
+    await open_history()
+    model_task = asyncio.create_task(model_loader_task())
+    await asyncio.to_thread(static_assets.load)
+    print(f"已從 '{static_assets.directory}' 載入 {len(static_assets.assets)} 個靜態檔案。")
+    static_watch_task = asyncio.create_task(static_assets.watch()) if STATIC_RELOAD else None
+    hub_tasks = [asyncio.create_task(session.run()) for session in hub_sessions.values()]
+    video_tasks = [asyncio.create_task(camera.streamer.run()) for camera in cameras.values()]
+    camera_stop.clear()
+    camera_threads = [threading.Thread(target=camera_thread_func, args=(camera,), name=f"camera-{camera.station}", daemon=True) for camera in cameras.values()]
+    for thread in camera_threads:
+        thread.start()
     yield
     print("--- 應用程式關閉中 ---")
-    bluetooth_task_instance.cancel()
+    model_task.cancel()
+    for task in hub_tasks:
+        task.cancel()
+    for task in video_tasks:
+        task.cancel()
+    if static_watch_task is not None:
+        static_watch_task.cancel()
+    camera_stop.set()
+    for thread in camera_threads:
+        await asyncio.to_thread(thread.join, CAMERA_STOP_TIMEOUT)
+        if thread.is_alive():
+            print(f"[{thread.name}] 鏡頭執行緒沒有在 {CAMERA_STOP_TIMEOUT} 秒內結束。")
+    inference_executor.shutdown(wait=False, cancel_futures=True)
+    for camera in cameras.values():
+        if camera.frame_ring is not None:
+            camera.frame_ring.close()
+    if session_recorder is not None:
+        session_recorder.close()
+    if history is not None:
+        await asyncio.to_thread(history.close)
 
 app = FastAPI(lifespan=lifespan)
 
+def load_model():
+    # torch / ultralytics 很重，只在背景執行緒第一次用到時才匯入
+    import numpy as np
+    if INFERENCE_ENGINE == "sim":
+        from hub_sim import SimulatedBackend
+        backend = SimulatedBackend(MODEL_PATH, imgsz=INFERENCE_IMGSZ)
+    else:
+        from inference_backends import create_backend
+        backend = create_backend(INFERENCE_ENGINE, MODEL_PATH, imgsz=INFERENCE_IMGSZ, int8=INFERENCE_INT8, int8_data=INFERENCE_INT8_DATA)
+    backend.load()
+    started = time.perf_counter()
+    backend.predict(np.zeros((INFERENCE_IMGSZ, INFERENCE_IMGSZ, 3), dtype=np.uint8))
+    print(f"成功以 {backend.engine}{' (INT8)' if INFERENCE_INT8 else ''} 從 '{MODEL_PATH}' 載入模型，暖機推論耗時 {time.perf_counter() - started:.2f} 秒。")
+    return backend
+
+def load_inspect_roi():
+    global inspect_roi
+    from roi import parse_roi
+    try:
+        inspect_roi = parse_roi(os.environ.get("WRO_INSPECT_ROI"))
+        if inspect_roi is None and os.path.exists(INSPECT_ROI_FILE):
+            with open(INSPECT_ROI_FILE, "r", encoding="utf-8") as f:
+                roi = json.load(f).get("roi")
+            inspect_roi = tuple(roi) if roi else None
+    except (OSError, ValueError) as e:
+        print(f"讀取檢查區域設定失敗，改用完整畫面: {e}")
+        inspect_roi = None
+    if inspect_roi:
+        print(f"電池檢查區域: {inspect_roi}，推論尺寸 {INSPECT_ROI_IMGSZ}")
+
+def save_inspect_roi():
+    with open(INSPECT_ROI_FILE, "w", encoding="utf-8") as f:
+        json.dump({"roi": list(inspect_roi) if inspect_roi else None}, f)
+
+def load_worker_model(barrier):
+    try:
+        inference_local.model = load_model()
+        return inference_local.model
+    finally:
+        # 所有執行緒都到齊才返回，執行緒池不會把兩次載入排給同一個執行緒
+        barrier.wait()
+
+def worker_model():
+    return getattr(inference_local, "model", None) or model
+
+async def model_loader_task():
+    global model, model_state
+    try:
+        if INFERENCE_MAX_IN_FLIGHT > 1:
+            barrier = threading.Barrier(INFERENCE_MAX_IN_FLIGHT)
+            loop = asyncio.get_running_loop()
+            models = await asyncio.gather(*[loop.run_in_executor(inference_executor, load_worker_model, barrier) for _ in range(INFERENCE_MAX_IN_FLIGHT)])
+            model = models[0]
+        else:
+            model = await asyncio.to_thread(load_model)
+        model_state = "ready"
+    except Exception as e:
+        print(f"使用 {INFERENCE_ENGINE} 載入模型失敗: {e}")
+        model_state = "failed"
+    model_ready.set()
+
+class ClientConnection:
+    def __init__(self, websocket: WebSocket, station: str | None = None):
+        self.websocket = websocket
+        self.station = station
+        self.queue = collections.deque()
+        self.wakeup = asyncio.Event()
+        self.dropped = 0
+        self.writer = None
+
+    def enqueue(self, message: str, key: str | None = None, coalesced=None):
+        # 同一個 key 的狀態訊息還沒送出時直接以新的取代，慢的連線只會收到最新狀態；
+        # 增量訊息不能直接取代前一則，改用 coalesced() 產生的完整快照
+        if key is not None:
+            for i, (queued_key, _) in enumerate(self.queue):
+                if queued_key == key:
+                    self.queue[i] = (key, coalesced() if coalesced is not None else message)
+                    self.dropped += 1
+                    WS_DROPPED.inc()
+                    return
+        if len(self.queue) >= WS_CLIENT_QUEUE_SIZE:
+            self.queue.popleft()
+            self.dropped += 1
+            WS_DROPPED.inc()
+        self.queue.append((key, message))
+        self.wakeup.set()
+
+    async def write_loop(self, manager):
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.queue:
+                    _, message = self.queue.popleft()
+                    await asyncio.wait_for(self.websocket.send_text(message), WS_SEND_TIMEOUT)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[WebSocket] 連線送出失敗，移除此連線: {e!r}")
+            manager.disconnect(self.websocket)
+            try:
+                await self.websocket.close()
+            except Exception:
+                pass
+
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: list[WebSocket] = []
-    async def connect(self, websocket: WebSocket):
+        self.active_connections: dict[WebSocket, ClientConnection] = {}
+    async def connect(self, websocket: WebSocket, station: str | None = None):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        client = ClientConnection(websocket, station)
+        client.writer = asyncio.create_task(client.write_loop(self))
+        self.active_connections[websocket] = client
+        return client
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
-    async def broadcast_data(self, data: dict):
+        client = self.active_connections.pop(websocket, None)
+        if client is not None and client.writer is not asyncio.current_task():
+            client.writer.cancel()
+    def broadcast_data(self, data: dict, key: str | None = None, station: str | None = None, snapshot=None):
+        # JSON 只序列化一次，實際送出交給各連線自己的 writer task；只送給訂閱該換電站或全部換電站的連線
+        # snapshot: 取代佇列中同 key 訊息時改送的完整狀態 (dict)，需要時才序列化一次
+        started = time.perf_counter()
         message = json.dumps(data)
-        print(f"[WebSocket] 發送資料: {message}")  
-        for connection in self.active_connections:
-            await connection.send_text(message)
+        snapshot_message = []
+        def coalesced():
+            if not snapshot_message:
+                snapshot_message.append(json.dumps(snapshot))
+            return snapshot_message[0]
+        for client in self.active_connections.values():
+            if client.station is None or station is None or client.station == station:
+                client.enqueue(message, key, coalesced if snapshot is not None else None)
+        BROADCAST_SECONDS.observe(time.perf_counter() - started)
 
 manager = ConnectionManager()
 
-latest_storage_status = {
-    "BLUE":  {"has_battery": 1, "charge": 60, "id": "blue-slot"},
-    "RED":   {"has_battery": 1, "charge": 95, "id": "red-slot"},
-    "GREEN": {"has_battery": 0, "charge": 0,  "id": "green-slot"}
-}
+class VideoStreamer:
+    # 每一幀只標註、編碼一次 (每種解析度一次)，所有觀看者共用同一份 JPEG；沒有觀看者時完全不編碼
+    def __init__(self, camera):
+        self.camera = camera
+        self.viewers = {}  # width -> 觀看者數量，0 代表原始解析度
+        self.jpegs = {}
+        self.seq = 0
+        self.new_frame = asyncio.Condition()
+        self.has_viewers = asyncio.Event()
+        self.annotate_buffer = None
+        self.resize_buffers = {}
+
+    def add_viewer(self, width):
+        self.viewers[width] = self.viewers.get(width, 0) + 1
+        self.has_viewers.set()
+
+    def remove_viewer(self, width):
+        self.viewers[width] -= 1
+        if not self.viewers[width]:
+            del self.viewers[width]
+        if not self.viewers:
+            self.has_viewers.clear()
+
+    def encode(self, pinned, widths):
+        import cv2
+        import numpy as np
+        try:
+            if self.annotate_buffer is None or self.annotate_buffer.shape != pinned.image.shape:
+                self.annotate_buffer = np.empty_like(pinned.image)
+                self.resize_buffers = {}
+            annotated = draw_detections(pinned.image, self.camera.latest_detection, self.annotate_buffer)
+            params = [cv2.IMWRITE_JPEG_QUALITY, STREAM_JPEG_QUALITY]
+            jpegs = {}
+            height, full_width = annotated.shape[:2]
+            for width in widths:
+                if width == 0 or width >= full_width:
+                    image = annotated
+                else:
+                    size = (width, height * width // full_width)
+                    if width not in self.resize_buffers:
+                        self.resize_buffers[width] = np.empty((size[1], size[0], annotated.shape[2]), dtype=annotated.dtype)
+                    image = cv2.resize(annotated, size, dst=self.resize_buffers[width], interpolation=cv2.INTER_AREA)
+                ok, encoded = cv2.imencode('.jpg', image, params)
+                if ok:
+                    jpegs[width] = encoded.tobytes()
+            return jpegs
+        finally:
+            pinned.release()
+
+    async def run(self):
+        min_interval = 1 / STREAM_MAX_FPS
+        while True:
+            await self.has_viewers.wait()
+            started = time.monotonic()
+            frame_ring = self.camera.frame_ring
+            if frame_ring is not None and frame_ring.latest_seq() != self.seq:
+                pinned = frame_ring.pin_latest()
+                jpegs = await asyncio.to_thread(self.encode, pinned, list(self.viewers))
+                async with self.new_frame:
+                    self.jpegs = jpegs
+                    self.seq = pinned.seq
+                    self.new_frame.notify_all()
+            await asyncio.sleep(max(0.0, min_interval - (time.monotonic() - started)))
+
+    async def frames(self, width, fps):
+        # 觀看者可以選較低的解析度與幀率；寬度以 80 像素為單位，避免產生太多種編碼
+        width = max(160, width // 80 * 80) if width > 0 else 0
+        interval = 1 / max(0.1, min(fps, STREAM_MAX_FPS))
+        self.add_viewer(width)
+        try:
+            last_seq = 0
+            while True:
+                async with self.new_frame:
+                    await self.new_frame.wait_for(lambda: self.seq != last_seq and width in self.jpegs)
+                    last_seq = self.seq
+                    jpeg = self.jpegs[width]
+                sent_at = time.monotonic()
+                yield jpeg
+                await asyncio.sleep(max(0.0, interval - (time.monotonic() - sent_at)))
+        finally:
+            self.remove_viewer(width)
+
+class StationCamera:
+    # 一個換電站的鏡頭：各自的環狀緩衝區、串流辨識結果與影像串流，由各自的鏡頭執行緒寫入
+    def __init__(self, station, source):
+        self.station = station
+        self.source = source
+        self.frame_ring = None
+        self.latest_detection = None
+        self.detection_waiters = []
+        self.streamer = VideoStreamer(self)
+
+def get_camera(station):
+    # 沒指定換電站時用第一個
+    return cameras.get(station or HUB_NAMES[0])
+
+@dataclass
+class StaticAsset:
+    media_type: str
+    mtime: float
+    etag: str
+    last_modified: str
+    variants: dict  # content-encoding -> body，"identity" 為原始內容
+
+class StaticAssetCache:
+    def __init__(self, directory, exclude=()):
+        self.directory = directory
+        # 執行時產生的資料 (例如歷史縮圖) 就算放在靜態目錄底下也不載入
+        self.exclude = [os.path.abspath(path) for path in exclude if path]
+        self.assets = {}
+        self.mtimes = {}
+
+    def scan(self):
+        mtimes = {}
+        for name in STATIC_FILES:
+            path = os.path.join(self.directory, name)
+            if os.path.isfile(path):
+                mtimes[name] = os.stat(path).st_mtime
+        for root, dirs, files in os.walk(os.path.join(self.directory, STATIC_SUBDIR)):
+            dirs[:] = [d for d in dirs if not d.startswith('.') and d != '__pycache__' and os.path.abspath(os.path.join(root, d)) not in self.exclude]
+            for name in files:
+                if os.path.splitext(name)[1].lower() in STATIC_MEDIA_TYPES:
+                    path = os.path.join(root, name)
+                    rel_path = os.path.relpath(path, self.directory).replace(os.sep, '/')
+                    mtimes[rel_path] = os.stat(path).st_mtime
+        return mtimes
+
+    def load(self):
+        mtimes = self.scan()
+        assets = {}
+        for rel_path, mtime in mtimes.items():
+            with open(os.path.join(self.directory, rel_path), 'rb') as f:
+                body = f.read()
+            media_type = STATIC_MEDIA_TYPES[os.path.splitext(rel_path)[1].lower()]
+            variants = {"identity": body}
+            if not media_type.startswith("image/") or media_type == "image/svg+xml":
+                variants["gzip"] = gzip.compress(body, compresslevel=9)
+                if brotli is not None:
+                    variants["br"] = brotli.compress(body, quality=11)
+            assets[rel_path] = StaticAsset(
+                media_type=media_type,
+                mtime=mtime,
+                etag=hashlib.sha1(body).hexdigest()[:20],
+                last_modified=formatdate(mtime, usegmt=True),
+                variants=variants,
+            )
+        self.assets = assets
+        self.mtimes = mtimes
+
+    async def watch(self, interval=1.0):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if await asyncio.to_thread(self.scan) != self.mtimes:
+                    await asyncio.to_thread(self.load)
+                    print("[Static] 偵測到檔案變更，已重新載入靜態檔案。")
+            except OSError as e:
+                print(f"[Static] 重新載入靜態檔案失敗: {e}")
+
+    def response(self, asset: StaticAsset, request: Request):
+        accept_encoding = request.headers.get("accept-encoding", "")
+        encoding = "identity"
+        for candidate in ("br", "gzip"):
+            if candidate in asset.variants and candidate in accept_encoding:
+                encoding = candidate
+                break
+        # 不同壓縮格式的內容不同，ETag 也要跟著區分
+        etag = f'"{asset.etag}"' if encoding == "identity" else f'"{asset.etag}-{encoding}"'
+        headers = {
+            "ETag": etag,
+            "Last-Modified": asset.last_modified,
+            "Cache-Control": "no-cache",
+            "Vary": "Accept-Encoding",
+        }
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match is not None:
+            not_modified = if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]
+        else:
+            not_modified = False
+            if_modified_since = request.headers.get("if-modified-since")
+            if if_modified_since:
+                try:
+                    not_modified = int(asset.mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+                except (TypeError, ValueError):
+                    pass
+        if not_modified:
+            return Response(status_code=304, headers=headers)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(asset.variants[encoding], media_type=asset.media_type, headers=headers)
+
+static_assets = StaticAssetCache(STATIC_DIR, exclude=[HISTORY_THUMBNAIL_DIR])
+
+@app.get("/api/status")
+async def api_status():
+    return {
+        "model": model_state,
+        "camera": any(camera.frame_ring is not None for camera in cameras.values()),
+        "hub_connected": any(session.connected for session in hub_sessions.values()),
+        "stations": [{"name": session.name, "connected": session.connected, "camera": cameras[session.name].frame_ring is not None,
+                      "cycles": session.cycle_stats} for session in hub_sessions.values()],
+    }
+
+@app.get("/metrics")
+async def metrics():
+    return Response(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/api/inspection/latest")
+async def latest_inspection(station: str | None = None):
+    if station is None:
+        return last_inspection
+    if station not in hub_sessions:
+        raise HTTPException(status_code=404, detail=f"未知的換電站 '{station}'")
+    return hub_sessions[station].last_inspection
+
+def require_history():
+    if history is None:
+        raise HTTPException(status_code=503, detail="歷史紀錄未啟用")
+    return history
+
+@app.get("/api/history/inspections")
+async def history_inspections(station: str | None = None, since: float | None = None, until: float | None = None,
+                              before_id: int | None = None, limit: int = 100):
+    store = require_history()
+    return await asyncio.to_thread(store.inspections, station=station, since=since, until=until, before_id=before_id, limit=min(max(1, limit), 1000))
+
+@app.get("/api/history/storage")
+async def history_storage(station: str | None = None, since: float | None = None, until: float | None = None,
+                          before_id: int | None = None, limit: int = 100):
+    store = require_history()
+    return await asyncio.to_thread(store.storage_snapshots, station=station, since=since, until=until, before_id=before_id, limit=min(max(1, limit), 1000))
+
+@app.get("/api/history/defect-rate")
+async def history_defect_rate(station: str | None = None, since: float | None = None, until: float | None = None, bucket: int = 3600):
+    store = require_history()
+    return await asyncio.to_thread(store.defect_rate, station=station, since=since, until=until, bucket=max(60, bucket))
+
+@app.get("/api/history/thumbnails/{name}")
+async def history_thumbnail(name: str):
+    store = require_history()
+    path = os.path.join(store.thumbnail_dir or "", os.path.basename(name))
+    if not store.thumbnail_dir or not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="找不到縮圖")
+    return FileResponse(path, media_type="image/jpeg")
+
+@app.get("/api/roi")
+async def get_roi():
+    return {"roi": inspect_roi, "imgsz": INSPECT_ROI_IMGSZ}
+
+@app.post("/api/roi")
+async def set_roi(request: Request):
+    global inspect_roi
+    try:
+        body = await request.json()
+    except ValueError:
+        body = None
+    roi = body.get("roi") if isinstance(body, dict) else []
+    # bool 也是 int 的子類別，要另外排除
+    if roi is not None and (not isinstance(roi, list) or len(roi) != 4 or not all(isinstance(v, int) and not isinstance(v, bool) for v in roi)
+                            or roi[2] <= 0 or roi[3] <= 0 or roi[0] < 0 or roi[1] < 0):
+        raise HTTPException(status_code=400, detail="roi 必須是 [x, y, w, h] 整數，或 null 代表完整畫面")
+    inspect_roi = tuple(roi) if roi else None
+    await asyncio.to_thread(save_inspect_roi)
+    return {"roi": inspect_roi, "imgsz": INSPECT_ROI_IMGSZ}
+
+@app.get("/stream.mjpg")
+async def video_mjpeg(station: str | None = None, width: int = 0, fps: float = STREAM_MAX_FPS):
+    camera = get_camera(station)
+    if camera is None:
+        raise HTTPException(status_code=404, detail="找不到這個換電站")
+    async def multipart():
+        async for jpeg in camera.streamer.frames(width, fps):
+            yield b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: " + str(len(jpeg)).encode() + b"\r\n\r\n" + jpeg + b"\r\n"
+    return StreamingResponse(multipart(), media_type="multipart/x-mixed-replace; boundary=frame")
+
+@app.websocket("/ws/video")
+async def video_websocket(websocket: WebSocket, station: str | None = None, width: int = 0, fps: float = STREAM_MAX_FPS):
+    camera = get_camera(station)
+    if camera is None:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    try:
+        async for jpeg in camera.streamer.frames(width, fps):
+            await websocket.send_bytes(jpeg)
+    except WebSocketDisconnect:
+        pass
 
 @app.get("/{full_path:path}")
-async def serve_spa(full_path: str):
-    return HTMLResponse(open(r"C:\Users\ken09\OneDrive\文件\wro\wro codes\wro-taiwan\main\index.html", "r", encoding="utf-8").read())
-    
+async def serve_spa(full_path: str, request: Request):
+    # 有對應的靜態檔案就直接回傳，其他路徑交給前端的 SPA 路由處理
+    asset = static_assets.assets.get(full_path) or static_assets.assets.get("index.html")
+    if asset is None:
+        return Response("index.html not found", status_code=404, media_type="text/plain")
+    return static_assets.response(asset, request)
+
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
-    await websocket.send_text(json.dumps(latest_storage_status))
+async def websocket_endpoint(websocket: WebSocket, station: str | None = None):
+    # ?station=<Hub 名稱> 只訂閱一個換電站，不指定則接收所有換電站的訊息
+    if station is not None and station not in hub_sessions:
+        await websocket.close(code=1008)
+        return
+    client = await manager.connect(websocket, station)
+    sessions = [session for session in hub_sessions.values() if station is None or session.name == station]
+    # 連線時先送完整快照與版本號，之後只送有變化的槽位
+    for session in sessions:
+        client.enqueue(json.dumps(session.storage_message()), key="storage:" + session.name)
     try:
         while True:
-            await websocket.receive_text()
+            # 儀表板發現版本號不連續時會送 {"type": "resync", "station": ...} 要求重送快照
+            try:
+                request = json.loads(await websocket.receive_text())
+            except ValueError:
+                continue
+            if isinstance(request, dict) and request.get("type") == "resync":
+                for session in sessions:
+                    if request.get("station") in (None, session.name):
+                        client.enqueue(json.dumps(session.storage_message()), key="storage:" + session.name)
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(websocket)
 
-def camera_thread_func():
-    global latest_frame
-    cap = cv2.VideoCapture(0)
+def draw_detections(frame, result, out):
+    # 畫框畫在預先配置好的 out 上，不會動到環狀緩衝區裡的原始畫面
+    if result is None or not result.detections:
+        return frame
+    import cv2
+    import numpy as np
+    annotated_frame = out
+    np.copyto(annotated_frame, frame)
+    for class_name, confidence, (x1, y1, x2, y2) in result.detections:
+        label = f"{class_name} {confidence:.2f}"
+        cv2.rectangle(annotated_frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
+        cv2.putText(annotated_frame, label, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+    return annotated_frame
+
+def camera_thread_func(camera):
+    import cv2
+    import numpy as np
+    from frame_ring import FrameRing
+    name = camera.station
+    # 錄製檔只有一路畫面，只錄第一個換電站的鏡頭
+    primary = name == HUB_NAMES[0]
+    lockstep = False
+    if SIMULATE:
+        from hub_sim import SyntheticCapture
+        cap = SyntheticCapture.from_env()
+    elif REPLAY_DIR:
+        if not primary:
+            print(f"[{name}] 重播只有第一個換電站的鏡頭畫面，這個換電站沒有鏡頭。")
+            return
+        from recorder import REPLAY
+        cap = REPLAY.capture()
+        # 盡快重播時每一幀都等上一幀推論完才讀下一幀，每次重播的結果才會一樣
+        lockstep = not REPLAY.realtime
+    else:
+        cap = cv2.VideoCapture(int(camera.source) if camera.source.isdigit() else camera.source)
     if not cap.isOpened():
-        print("錯誤：無法開啟鏡頭。")
+        print(f"[{name}] 錯誤：無法開啟鏡頭。")
         return
-    print("鏡頭已啟動，按 'q' 鍵關閉視窗。")
-    while True:
-        ret, frame = cap.read()
+    print(f"[{name}] 鏡頭已啟動。" + (" 按 'q' 鍵關閉視窗。" if PREVIEW_WINDOW else ""))
+    ret, frame = cap.read()
+    if not ret:
+        print(f"[{name}] 錯誤：無法從鏡頭讀取畫面。")
+        cap.release()
+        return
+    slots = max(FRAME_RING_SLOTS, INSPECT_VOTE_FRAMES + 3) if INSPECT_MODE == "vote" else FRAME_RING_SLOTS
+    frame_ring = camera.frame_ring = FrameRing(frame.shape, slots)
+    frames_counter = CAMERA_FRAMES.labels(name)
+    fps_gauge = CAMERA_FPS.labels(name)
+    preview_buffer = np.empty_like(frame) if PREVIEW_WINDOW else None
+    seq = 0
+    pending_inference = None
+    fps_started = time.monotonic()
+    fps_frames = 0
+    while not camera_stop.is_set():
+        if lockstep and pending_inference is not None:
+            pending_inference.result()
+        slot = frame_ring.begin_write()
+        if slot is None:
+            # 所有槽位都被讀取端鎖住，丟掉這一幀
+            cap.grab()
+            continue
+        read_started = time.perf_counter()
+        ret, frame = cap.read(frame_ring.frames[slot])
         if not ret:
             break
-        with frame_lock:
-            latest_frame = frame.copy()
-        if model is not None:
-            annotated_frame = frame.copy()
-            results = model(frame, verbose=False)
-            for box in results[0].boxes:
-                confidence = box.conf[0].item()
-                if confidence > 0.7:
-                    x1, y1, x2, y2 = map(int, box.xyxy[0])
-                    class_id = int(box.cls[0].item())
-                    class_name = model.names[class_id]
-                    label = f"{class_name} {confidence:.2f}"
-                    cv2.rectangle(annotated_frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-                    cv2.putText(annotated_frame, label, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
-            cv2.imshow('Spike Hub Battery Check', annotated_frame)
+        CAMERA_READ_SECONDS.observe(time.perf_counter() - read_started)
+        frames_counter.inc()
+        fps_frames += 1
+        if time.monotonic() - fps_started >= 1.0:
+            fps_gauge.set(fps_frames / (time.monotonic() - fps_started))
+            fps_started = time.monotonic()
+            fps_frames = 0
+        if frame is not frame_ring.frames[slot]:
+            np.copyto(frame_ring.frames[slot], frame)
+        seq += 1
+        frame_ring.commit(slot, seq, time.monotonic())
+        if session_recorder is not None and primary:
+            session_recorder.record_frame(seq, time.monotonic(), frame_ring.frames[slot])
+        # 推論執行緒忙碌時直接跳過這一幀，只把最新的畫面送去辨識
+        if model is not None and (pending_inference is None or pending_inference.done()):
+            pinned = frame_ring.pin(seq)
+            pending_inference = inference_executor.submit(run_stream_inference, camera, pinned)
+        if PREVIEW_WINDOW:
+            cv2.imshow(f'Spike Hub Battery Check - {name}', draw_detections(frame_ring.frames[slot], camera.latest_detection, preview_buffer))
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                break
+    # 等最後一次推論放開它 pin 住的畫面，之後才能關閉環狀緩衝區
+    if pending_inference is not None:
+        pending_inference.result()
+    cap.release()
+    if PREVIEW_WINDOW:
+        cv2.destroyWindow(f'Spike Hub Battery Check - {name}')
+    print(f"[{name}] 鏡頭已關閉。")
+
+def get_roi_letterbox(frame_shape):
+    # ROI 或畫面大小改變時才重新計算 letterbox 參數
+    global roi_letterbox
+    # 各換電站的鏡頭在不同執行緒推論，只讀一次全域變數，不會拿到另一支鏡頭剛換上的 letterbox
+    roi = inspect_roi
+    letterbox = roi_letterbox
+    if roi is None:
+        return None
+    if letterbox is None or letterbox.frame_shape != tuple(frame_shape) or letterbox.requested_roi != roi:
+        from roi import RoiLetterbox
+        letterbox = roi_letterbox = RoiLetterbox(frame_shape, roi, INSPECT_ROI_IMGSZ)
+    return letterbox
+
+def run_inference(frame):
+    return run_batch_inference([frame], DEFECT_CONFIDENCE)[0]
+
+def run_batch_inference(frames, min_confidence):
+    # 多幀一次送進模型推論，回傳每一幀的偵測結果
+    letterbox = get_roi_letterbox(frames[0].shape)
+    if letterbox is None:
+        return worker_model().detect(list(frames), min_confidence)
+    inputs = letterbox.prepare(frames)
+    return [letterbox.map_back(d) for d in worker_model().detect(list(inputs), min_confidence, imgsz=letterbox.imgsz)]
+
+def run_vote_inference(pinned_frames):
+    started = time.perf_counter()
+    try:
+        return run_batch_inference([pinned.image for pinned in pinned_frames], VOTE_MIN_CONFIDENCE)
+    finally:
+        INFERENCE_SECONDS.labels("vote").observe(time.perf_counter() - started)
+        for pinned in pinned_frames:
+            pinned.release()
+
+def vote_detections(frame_detections):
+    # frame_detections: [(seq, detections)]，回傳 ({瑕疵類別: 分數}, 每一幀各類別的最高信心值)
+    classes = sorted({class_name for _, detections in frame_detections for class_name, _, _ in detections})
+    frame_scores = []
+    for seq, detections in frame_detections:
+        scores = {c: max((conf for name, conf, _ in detections if name == c), default=0.0) for c in classes}
+        frame_scores.append({"seq": seq, "scores": scores})
+    defects = {}
+    for c in classes:
+        scores = [frame["scores"][c] for frame in frame_scores]
+        if INSPECT_VOTE_POLICY == "confidence":
+            mean_score = sum(scores) / len(scores)
+            if mean_score > INSPECT_VOTE_THRESHOLD:
+                defects[c] = mean_score
         else:
-            cv2.imshow('Spike Hub Battery Check', frame)
-        if cv2.waitKey(1) & 0xFF == ord('q'):
+            hits = [s for s in scores if s > DEFECT_CONFIDENCE]
+            if len(hits) * 2 > len(scores):
+                defects[c] = sum(hits) / len(hits)
+    return defects, frame_scores
+
+async def inspect_by_vote(camera, not_before):
+    deadline = time.monotonic() + INSPECT_WAIT_TIMEOUT
+    while True:
+        frame_ring = camera.frame_ring if camera is not None else None
+        pinned_frames = frame_ring.pin_recent(INSPECT_VOTE_FRAMES, not_before) if frame_ring is not None else None
+        if pinned_frames:
             break
-    cap.release()
-    cv2.destroyAllWindows()
-    print("鏡頭視窗已關閉。")
+        if time.monotonic() > deadline:
+            raise asyncio.TimeoutError()
+        await asyncio.sleep(0.01)
+    seqs = [pinned.seq for pinned in pinned_frames]
+    loop = asyncio.get_running_loop()
+    frame_detections = await loop.run_in_executor(inference_executor, run_vote_inference, pinned_frames)
+    return vote_detections(list(zip(seqs, frame_detections)))
 
-async def send_response_to_hub(message: str):
-    if hub_client and hub_client.is_connected:
-        try:
-            payload = b'\x06' + (message + '\n').encode('utf-8')
-            await hub_client.write_gatt_char(PYBRICKS_UNIVERSAL_CHAR_UUID, payload)
-            print(f"成功發送回應 '{message}' 至 Spike Hub。")
-            return True
-        except Exception as e:
-            print(f"嘗試發送回應 '{message}' 時發生錯誤: {e}")
-            return False
-    else:
-        print("Hub 未連接，無法發送回應。")
-        return False
+def run_stream_inference(camera, pinned):
+    started = time.perf_counter()
+    try:
+        result = DetectionResult(pinned.seq, pinned.timestamp, run_inference(pinned.image))
+        INFERENCE_SECONDS.labels("stream").observe(time.perf_counter() - started)
+    except Exception as e:
+        print(f"推論第 {pinned.seq} 幀時出錯: {e}")
+        result = DetectionResult(pinned.seq, pinned.timestamp, error=str(e))
+    finally:
+        pinned.release()
+    publish_detection(camera, result)
 
-async def analyze_battery_status():
-    global ai_result_to_send, latest_frame, model
-    if model is None or latest_frame is None:
-        print("模型或鏡頭畫面尚未準備好。")
-        return
-    with frame_lock:
-        frame_to_process = latest_frame.copy()
+def publish_detection(camera, result):
+    camera.latest_detection = result
+    if main_loop is not None:
+        main_loop.call_soon_threadsafe(resolve_detection_waiters, camera, result)
+
+def resolve_detection_waiters(camera, result):
+    for waiter in list(camera.detection_waiters):
+        not_before, future = waiter
+        if result.timestamp >= not_before:
+            camera.detection_waiters.remove(waiter)
+            if not future.done():
+                future.set_result(result)
+
+async def wait_for_detection(camera, not_before, timeout):
+    if camera is None:
+        await asyncio.sleep(timeout)
+        raise asyncio.TimeoutError()
+    result = camera.latest_detection
+    if result is not None and result.timestamp >= not_before:
+        return result
+    waiter = (not_before, asyncio.get_running_loop().create_future())
+    camera.detection_waiters.append(waiter)
+    try:
+        return await asyncio.wait_for(waiter[1], timeout)
+    finally:
+        if waiter in camera.detection_waiters:
+            camera.detection_waiters.remove(waiter)
+
+async def analyze_battery_status(station=None, requested_at=None):
+    global last_inspection
+    if not model_ready.is_set():
+        print("模型仍在載入中，等待模型就緒...")
+        try:
+            await asyncio.wait_for(model_ready.wait(), MODEL_READY_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+    if model_state != "ready":
+        print(f"模型尚未準備好 ({model_state})。")
+        return None
+    # 以收到 INSPECT 的時間為準，等模型載入的時間不會讓較舊的畫面被接受
+    not_before = (time.monotonic() if requested_at is None else requested_at) - INSPECT_MAX_RESULT_AGE
+    camera = get_camera(station)
+    frame_scores = []
     try:
-        results = model(frame_to_process, verbose=False)
-        detected_defects = []
-        for box in results[0].boxes:
-            confidence = box.conf[0].item()
-            if confidence > 0.7:
-                class_id = int(box.cls[0].item())
-                class_name = model.names[class_id]
-                detected_defects.append(f"{class_name}({confidence:.2f})")
+        if INSPECT_MODE == "vote":
+            defects, frame_scores = await inspect_by_vote(camera, not_before)
+            detected_defects = [f"{class_name}({score:.2f})" for class_name, score in defects.items()]
+        else:
+            # 不另外跑一次模型，而是等待鏡頭串流中夠新的辨識結果
+            result = await wait_for_detection(camera, not_before, INSPECT_WAIT_TIMEOUT)
+            if result.error:
+                raise RuntimeError(result.error)
+            _, frame_scores = vote_detections([(result.seq, result.detections)])
+            detected_defects = [f"{class_name}({confidence:.2f})" for class_name, confidence, _ in result.detections]
+        frames_text = ", ".join(f"#{frame['seq']} {frame['scores']}" for frame in frame_scores)
         if detected_defects:
             prediction = ", ".join(detected_defects)
-            print(f"偵測到瑕疵: {prediction}")
+            print(f"偵測到瑕疵: {prediction} [{frames_text}]")
         else:
             prediction = "no_defect"
-            print("未偵測到任何瑕疵。")
+            print(f"未偵測到任何瑕疵。[{frames_text}]")
+    except asyncio.TimeoutError:
+        print("等待鏡頭辨識結果逾時。")
+        prediction = "error"
     except Exception as e:
         print(f"解析 YOLO 結果時出錯: {e}")
         prediction = "error"
-    print(f"辨識完成，結果為: {prediction}。等待 Spike Hub 請求...")
-    with ai_result_lock:
-        ai_result_to_send = prediction
+    print(f"辨識完成，結果為: {prediction}。")
+    detections = []
+    if prediction not in ("error", "no_defect"):
+        if INSPECT_MODE == "vote":
+            detections = [{"class": class_name, "confidence": score} for class_name, score in defects.items()]
+        else:
+            detections = [{"class": class_name, "confidence": confidence, "box": box} for class_name, confidence, box in result.detections]
+    last_inspection = {
+        "station": station,
+        "time": time.time(),
+        "mode": INSPECT_MODE,
+        "policy": INSPECT_VOTE_POLICY if INSPECT_MODE == "vote" else None,
+        "prediction": prediction,
+        "frames": frame_scores,
+        "detections": detections,
+    }
+    return last_inspection
 
-def handle_rx(_, data: bytearray):
-    global data_buffer
-    data_buffer += data
-    while True:
-        start_index = data_buffer.find(b'>')
-        if start_index == -1:
-            if len(data_buffer) > 1024:
-                data_buffer = b''
-            break
-        data_buffer = data_buffer[start_index:]
-        if len(data_buffer) < 3:
-            break
-        packet_type = data_buffer[1]
-        payload_len = data_buffer[2]
-        full_packet_len = 3 + payload_len + 1
-        if len(data_buffer) < full_packet_len:
-            break
-        if data_buffer[full_packet_len - 1] != ord('<'):
-            data_buffer = data_buffer[1:]
-            continue
-        payload = data_buffer[3 : 3 + payload_len]
-        process_packet(packet_type, payload)
-        data_buffer = data_buffer[full_packet_len:]
-
-def process_packet(packet_type, payload):
-    if packet_type == PACKET_TYPE_STORAGE:
-        handle_storage_packet(payload)
-    elif packet_type == PACKET_TYPE_COMMAND:
-        handle_command_packet(payload)
-    elif packet_type == PACKET_TYPE_LOG:
-        print(f"[Hub Log]: {payload.decode('utf-8', errors='ignore')}")
-    else:
-        print(f"收到未知的封包類型: {packet_type}")
+def capture_thumbnail(station, seq):
+    # 辨識用的那一幀若已被覆寫就改用最新的畫面
+    import cv2
+    camera = get_camera(station)
+    frame_ring = camera.frame_ring if camera is not None else None
+    if frame_ring is None or not HISTORY_THUMBNAIL_DIR:
+        return None
+    pinned = (frame_ring.pin(seq) if seq is not None else None) or frame_ring.pin_latest()
+    if pinned is None:
+        return None
+    with pinned:
+        height, width = pinned.image.shape[:2]
+        size = (HISTORY_THUMBNAIL_WIDTH, max(1, height * HISTORY_THUMBNAIL_WIDTH // width))
+        return cv2.resize(pinned.image, size, interpolation=cv2.INTER_AREA)
 
-def handle_storage_packet(payload):
-    global latest_storage_status
+async def open_history():
+    global history
+    if not HISTORY_DB:
+        return
+    from history import HistoryStore
     try:
-        unpacked_data = struct.unpack('>BBBBBB', payload)
-        latest_storage_status["BLUE"]["has_battery"] = unpacked_data[0]
-        latest_storage_status["BLUE"]["charge"] = unpacked_data[1]
-        latest_storage_status["RED"]["has_battery"] = unpacked_data[2]
-        latest_storage_status["RED"]["charge"] = unpacked_data[3]
-        latest_storage_status["GREEN"]["has_battery"] = unpacked_data[4]
-        latest_storage_status["GREEN"]["charge"] = unpacked_data[5]
-        asyncio.create_task(manager.broadcast_data(latest_storage_status))
+        history = await asyncio.to_thread(HistoryStore, HISTORY_DB, HISTORY_THUMBNAIL_DIR)
     except Exception as e:
-        print(f"解包 storage 數據時出錯: {e}")
+        print(f"開啟歷史資料庫 '{HISTORY_DB}' 失敗，不記錄歷史: {e}")
+        return
+    # 重新啟動後沿用最後一次記錄的電池倉狀態，而不是預設值
+    for session in hub_sessions.values():
+        data = await asyncio.to_thread(history.last_storage, session.name)
+        if data:
+            session.storage_status = data
+            print(f"[{session.name}] 已從歷史紀錄還原電池倉狀態。")
 
-def handle_command_packet(payload):
-    global ai_result_to_send
-    try:
-        command = payload.decode('utf-8')
-        if command == 'INSPECT':
-            print("收到來自 Hub 的影像辨識請求！")
-            with ai_result_lock:
-                ai_result_to_send = None
-            asyncio.create_task(analyze_battery_status())
-        elif command == 'RDY_FOR_RESULT':
-            with ai_result_lock:
-                if ai_result_to_send is not None:
-                    defects = ai_result_to_send.lower()
-                    # 只要有瑕疵就是錯誤
-                    if defects == "no_defect":
-                        message_to_send = "OK"
-                    else:
-                        message_to_send = "DIRTY"
-                    print(f"Sending to Hub: {message_to_send}")
-                    asyncio.create_task(send_response_to_hub(message_to_send))
-                    ai_result_to_send = None
-    except Exception as e:
-        print(f"解碼指令時出錯: {e}")
+def format_verdict(request_id, verdict):
+    return f"{request_id}:{verdict}" if request_id else verdict
 
-async def bluetooth_task():
-    global hub_client
-    print("藍牙任務已啟動...")
-    while True:
-        try:
-            print(f"正在掃描 '{HUB_NAME}'...")
-            device = await BleakScanner.find_device_by_name(HUB_NAME, timeout=5.0)
-            if not device:
-                print(f"找不到 '{HUB_NAME}'，5 秒後重試...")
-                await asyncio.sleep(5)
+STORAGE_COLORS = ("BLUE", "RED", "GREEN")
+
+def new_storage_status():
+    return {
+        "BLUE":  {"has_battery": 1, "charge": 60, "id": "blue-slot"},
+        "RED":   {"has_battery": 1, "charge": 95, "id": "red-slot"},
+        "GREEN": {"has_battery": 0, "charge": 0,  "id": "green-slot"}
+    }
+
+class HubSession:
+    # 一個換電站 (一台 Hub) 的連線與狀態：各自的封包解碼器、INSPECT 判定結果與電池倉狀態，
+    # 所有 Hub 共用同一個 event loop、鏡頭與推論執行緒池
+    def __init__(self, name):
+        self.name = name
+        self.client = None
+        self.decoder = PacketDecoder()
+        self.storage_status = new_storage_status()
+        # 電池倉狀態每次有變化就加一，儀表板以此檢查是否漏掉增量訊息
+        self.storage_version = 0
+        # 每個 INSPECT 請求 ID 的判定結果，Hub 補問 RDY_FOR_RESULT 時可以直接重送
+        self.inspection_verdicts = collections.OrderedDict()
+        # 還在辨識中的請求 ID，避免補問 RDY_FOR_RESULT 時重複辨識
+        self.inspections_in_flight = set()
+        self.last_inspection = None
+        self.cycle_stats = None
+        # write_gatt_char 只由 write_loop 呼叫，其他地方一律透過 send_response 排入佇列
+        self.write_queue = collections.deque()
+        self.write_wakeup = asyncio.Event()
+
+    @property
+    def connected(self):
+        return bool(self.client and self.client.is_connected)
+
+    def storage_message(self):
+        return {"type": "storage", "station": self.name, "version": self.storage_version, "data": self.storage_status}
+
+    def send_response(self, message: str, key: str | None = None):
+        # 回傳送出完成時結束的 future (結果為 True/False)；同一個 key 還沒開始送的訊息直接以新的取代
+        data = (message + '\n').encode('utf-8')
+        if key is not None:
+            for item in self.write_queue:
+                if item.key == key and item.offset == 0:
+                    item.data = data
+                    BLE_WRITES_DROPPED.labels("coalesced").inc()
+                    return item.done
+        if len(self.write_queue) >= HUB_WRITE_QUEUE_SIZE:
+            dropped = self.write_queue.popleft()
+            BLE_WRITES_DROPPED.labels("overflow").inc()
+            print(f"[{self.name}] 寫入佇列已滿，丟棄 '{dropped.data.decode('utf-8', errors='ignore').strip()}'。")
+            self.finish_write(dropped, False)
+        item = HubWrite(key, data, asyncio.get_running_loop().create_future(), time.monotonic())
+        self.write_queue.append(item)
+        self.write_wakeup.set()
+        return item.done
+
+    def finish_write(self, item, ok):
+        if ok:
+            BLE_WRITE_QUEUE_SECONDS.observe(time.monotonic() - item.queued_at)
+        if not item.done.done():
+            item.done.set_result(ok)
+
+    async def write_loop(self):
+        while True:
+            await self.write_wakeup.wait()
+            self.write_wakeup.clear()
+            # 斷線時保留佇列，重新連上後 run() 會再喚醒這裡
+            while self.write_queue and self.connected:
+                item = self.write_queue.popleft()
+                message = item.data.decode('utf-8', errors='ignore').strip()
+                if time.monotonic() - item.queued_at > HUB_WRITE_MAX_AGE:
+                    BLE_WRITES_DROPPED.labels("stale").inc()
+                    print(f"[{self.name}] 回應 '{message}' 等待太久，不再送出。")
+                    self.finish_write(item, False)
+                    continue
+                ok = await self.write_item(item)
+                if ok is None:
+                    self.write_queue.appendleft(item)
+                    break
+                if ok:
+                    print(f"[{self.name}] 成功發送回應 '{message}' 至 Spike Hub。")
+                self.finish_write(item, ok)
+
+    async def write_item(self, item):
+        # 依 MTU 切段，每段都要加上 Pybricks 的 write stdin 指令碼；暫時性錯誤以指數退避重試，斷線則回傳 None
+        chunk_size = max(1, getattr(self.client, "mtu_size", 23) - 3 - 1)
+        attempt = 0
+        while item.offset < len(item.data):
+            chunk = item.data[item.offset:item.offset + chunk_size]
+            started = time.perf_counter()
+            try:
+                await self.client.write_gatt_char(PYBRICKS_UNIVERSAL_CHAR_UUID, bytes([PYBRICKS_COMMAND_WRITE_STDIN]) + chunk)
+            except Exception as e:
+                if not self.connected:
+                    return None
+                attempt += 1
+                if attempt > HUB_WRITE_RETRIES:
+                    BLE_WRITE_ERRORS.inc()
+                    print(f"[{self.name}] 發送回應時發生錯誤，已重試 {HUB_WRITE_RETRIES} 次: {e}")
+                    return False
+                BLE_WRITE_RETRIES.inc()
+                await asyncio.sleep(HUB_WRITE_BACKOFF * 2 ** (attempt - 1))
                 continue
-            print(f"找到 Hub: {device.address}")
-            async with BleakClient(device) as client:
-                hub_client = client
-                print("成功連接到 Hub。正在訂閱通知...")
-                await client.start_notify(PYBRICKS_UNIVERSAL_CHAR_UUID, handle_rx)
-                print("訂閱成功。正在監聽數據...")
-                while client.is_connected:
-                    await asyncio.sleep(1)
-            print("Hub 已斷線。準備重新連接...")
-            hub_client = None
-        except asyncio.CancelledError:
-            print("藍牙任務被取消。")
-            break
+            BLE_WRITE_SECONDS.observe(time.perf_counter() - started)
+            item.offset += len(chunk)
+            attempt = 0
+        return True
+
+    def start_inspection(self, request_id):
+        self.inspection_verdicts.pop(request_id, None)
+        self.inspections_in_flight.add(request_id)
+        asyncio.create_task(self.inspect_and_reply(request_id, time.perf_counter(), time.monotonic()))
+
+    async def inspect_and_reply(self, request_id, received_at, requested_at):
+        # received_at 用來計算延遲 (perf_counter)；requested_at 與畫面時間戳同一個時鐘 (monotonic)
+        INSPECTIONS_IN_FLIGHT.inc()
+        try:
+            inspection = await analyze_battery_status(self.name, requested_at)
+        finally:
+            INSPECTIONS_IN_FLIGHT.dec()
+            self.inspections_in_flight.discard(request_id)
+        if inspection is None:
+            return
+        self.last_inspection = inspection
+        # 只要有瑕疵就是錯誤
+        verdict = "OK" if inspection["prediction"].lower() == "no_defect" else "DIRTY"
+        self.inspection_verdicts[request_id] = verdict
+        while len(self.inspection_verdicts) > INSPECTION_VERDICTS_KEEP:
+            self.inspection_verdicts.popitem(last=False)
+        # 辨識完成就主動推送結果，不必等 Hub 下一次輪詢
+        print(f"[{self.name}] Sending to Hub: {format_verdict(request_id, verdict)}")
+        latency = None
+        if await self.send_response(format_verdict(request_id, verdict), key=request_id):
+            latency = time.perf_counter() - received_at
+            INSPECT_SECONDS.observe(latency)
+        INSPECTIONS.labels(verdict).inc()
+        if history is not None:
+            thumbnail = await asyncio.to_thread(capture_thumbnail, self.name, inspection["frames"][-1]["seq"] if inspection["frames"] else None)
+            history.record_inspection(self.name, inspection, request_id, verdict, latency, thumbnail)
+
+    def handle_rx(self, _, data: bytearray):
+        if session_recorder is not None:
+            session_recorder.record_ble(self.name, data)
+        if not data or data[0] != PYBRICKS_EVENT_WRITE_STDOUT:
+            return
+        for packet_type, payload in self.decoder.feed(memoryview(data)[1:]):
+            self.process_packet(packet_type, payload)
+
+    def process_packet(self, packet_type, payload):
+        if packet_type == PACKET_TYPE_STORAGE:
+            self.handle_storage_packet(payload)
+        elif packet_type == PACKET_TYPE_COMMAND:
+            self.handle_command_packet(payload)
+        elif packet_type == PACKET_TYPE_LOG:
+            print(f"[Hub Log][{self.name}]: {str(payload, 'utf-8', errors='ignore')}")
+        elif packet_type == PACKET_TYPE_STATS:
+            self.handle_stats_packet(payload)
+        else:
+            print(f"[{self.name}] 收到未知的封包類型: {packet_type}")
+
+    def handle_storage_packet(self, payload):
+        try:
+            unpacked_data = struct.unpack('>BBBBBB', payload)
+            changed = {}
+            for i, color in enumerate(STORAGE_COLORS):
+                slot = self.storage_status[color]
+                has_battery, charge = unpacked_data[2 * i], unpacked_data[2 * i + 1]
+                if slot["has_battery"] != has_battery or slot["charge"] != charge:
+                    slot["has_battery"] = has_battery
+                    slot["charge"] = charge
+                    changed[color] = slot
+            # Hub 會一直重送相同的狀態，沒有變化就不推播也不記錄
+            if not changed:
+                return
+            self.storage_version += 1
+            delta = {"type": "storage_delta", "station": self.name, "version": self.storage_version, "slots": changed}
+            manager.broadcast_data(delta, key="storage:" + self.name, station=self.name, snapshot=self.storage_message())
+            if history is not None:
+                history.record_storage(self.name, self.storage_status)
         except Exception as e:
-            print(f"藍牙任務發生錯誤: {e}。準備重試...")
-            hub_client = None
-            await asyncio.sleep(5)
+            print(f"[{self.name}] 解包 storage 數據時出錯: {e}")
+
+    def handle_stats_packet(self, payload):
+        try:
+            cycles, cycle_ms, elapsed_ms = struct.unpack(CYCLE_STATS_FORMAT, payload)
+        except struct.error as e:
+            print(f"[{self.name}] 解包 stats 數據時出錯: {e}")
+            return
+        self.cycle_stats = {
+            "cycles": cycles,
+            "cycle_seconds": cycle_ms / 1000,
+            "elapsed_seconds": elapsed_ms / 1000,
+            "per_hour": cycles * 3600000 / elapsed_ms if elapsed_ms else 0.0,
+        }
+        ARM_CYCLES.inc()
+        ARM_CYCLE_SECONDS.observe(cycle_ms / 1000)
+        print(f"[{self.name}] 第 {cycles} 顆電池完成，耗時 {cycle_ms / 1000:.1f} 秒，平均每小時 {self.cycle_stats['per_hour']:.1f} 顆。")
+
+    def handle_command_packet(self, payload):
+        try:
+            # 指令格式為 "INSPECT:<id>"、"RDY_FOR_RESULT:<id>"，沒有 ID 的舊格式也照樣處理
+            command, _, request_id = str(payload, 'utf-8').partition(':')
+            if command == 'INSPECT':
+                print(f"[{self.name}] 收到來自 Hub 的影像辨識請求！(ID: {request_id or '-'})")
+                self.start_inspection(request_id)
+            elif command == 'RDY_FOR_RESULT':
+                # Hub 等太久沒收到推送時才會補問，若結果已經出來就重送一次
+                verdict = self.inspection_verdicts.get(request_id)
+                if verdict is not None:
+                    print(f"[{self.name}] Resending to Hub: {format_verdict(request_id, verdict)}")
+                    self.send_response(format_verdict(request_id, verdict), key=request_id)
+                elif request_id not in self.inspections_in_flight:
+                    # INSPECT 封包在傳輸中損壞或遺失，沒有補做的話 Hub 只會等到逾時
+                    print(f"[{self.name}] 沒有收到 ID {request_id or '-'} 的 INSPECT，現在開始辨識。")
+                    self.start_inspection(request_id)
+        except Exception as e:
+            print(f"[{self.name}] 解碼指令時出錯: {e}")
+
+    async def run(self):
+        print(f"[{self.name}] 藍牙任務已啟動...")
+        writer = asyncio.create_task(self.write_loop())
+        try:
+            await self.connect_loop()
+        finally:
+            writer.cancel()
+
+    async def connect_loop(self):
+        connected_before = False
+        while True:
+            try:
+                print(f"正在掃描 '{self.name}'...")
+                device = await BleakScanner.find_device_by_name(self.name, timeout=5.0)
+                if not device:
+                    print(f"找不到 '{self.name}'，5 秒後重試...")
+                    await asyncio.sleep(5)
+                    continue
+                print(f"[{self.name}] 找到 Hub: {device.address}")
+                async with BleakClient(device) as client:
+                    self.client = client
+                    if connected_before:
+                        BLE_RECONNECTS.inc()
+                    connected_before = True
+                    print(f"[{self.name}] 成功連接到 Hub。正在訂閱通知...")
+                    await client.start_notify(PYBRICKS_UNIVERSAL_CHAR_UUID, self.handle_rx)
+                    print(f"[{self.name}] 訂閱成功。正在監聽數據...")
+                    # 斷線期間排入的回應在重新連上後送出
+                    self.write_wakeup.set()
+                    while client.is_connected:
+                        await asyncio.sleep(1)
+                print(f"[{self.name}] Hub 已斷線。準備重新連接...")
+                self.client = None
+            except asyncio.CancelledError:
+                print(f"[{self.name}] 藍牙任務被取消。")
+                break
+            except Exception as e:
+                print(f"[{self.name}] 藍牙任務發生錯誤: {e}。準備重試...")
+                self.client = None
+                await asyncio.sleep(5)
+
+hub_sessions = {name: HubSession(name) for name in HUB_NAMES}
+cameras = {name: StationCamera(name, CAMERA_SOURCES[i] if i < len(CAMERA_SOURCES) else None) for i, name in enumerate(HUB_NAMES)}
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(__name__ + ":app", host="0.0.0.0", port=8000, reload=True)
+    # reload 會在每次重新載入時重跑整個啟動流程，只在開發時用 WRO_RELOAD=1 開啟
+    uvicorn.run(__name__ + ":app", host="0.0.0.0", port=8000, reload=os.environ.get("WRO_RELOAD", "0") == "1")
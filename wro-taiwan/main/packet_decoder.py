@@ -0,0 +1,74 @@
+PACKET_START = ord('>')
+PACKET_END = ord('<')
+HEADER_LEN = 3  # '>' + type + len
+
+# `>` type len payload `<` 格式的增量解碼器。
+# 資料累積在同一個 bytearray 裡，以讀取位置 offset 前進，不會每次都重新切片；
+# feed 直接在迴圈裡解碼並回傳這次收完的封包 list，payload 是 bytearray 複本 (最多 255 bytes)，可以保留；
+# BLE 通知多半只有 20 bytes 左右，複製小 payload 比每次建立 generator 和 memoryview 便宜。
+# 上一次停在還沒收完的封包時會記下需要的緩衝區長度，小片段補不完就直接返回，不必重新掃描。
+
+class PacketDecoder:
+    def __init__(self, compact_threshold=1024):
+        self.buffer = bytearray()
+        self.offset = 0
+        # 緩衝區至少要這麼長才可能有完整的封包
+        self.needed = 0
+        self.compact_threshold = compact_threshold
+        self.packets = 0
+        self.resyncs = 0
+        self.garbage_bytes = 0
+
+    def feed(self, data):
+        # 回傳 [(type, payload), ...]；封包還沒收完時回傳空 tuple。計數器先累積在區域變數，離開時才寫回
+        buf = self.buffer
+        buf += data
+        end = len(buf)
+        if end < self.needed:
+            return ()
+        packets = []
+        pos = self.offset
+        needed = 0
+        garbage = 0
+        while pos < end:
+            # 沒有雜訊時讀取位置通常就停在 '>'，不必呼叫 find
+            if buf[pos] != PACKET_START:
+                start = buf.find(b'>', pos)
+                if start == -1:
+                    garbage += end - pos
+                    pos = end
+                    break
+                garbage += start - pos
+                pos = start
+            if end - pos < HEADER_LEN:
+                needed = pos + HEADER_LEN
+                break
+            packet_end = pos + HEADER_LEN + 1 + buf[pos + 2]
+            if end < packet_end:
+                needed = packet_end
+                break
+            if buf[packet_end - 1] != PACKET_END:
+                # 結尾不是 '<'，這個 '>' 只是雜訊，往後一個位元組重新同步
+                self.resyncs += 1
+                garbage += 1
+                pos += 1
+                continue
+            packets.append((buf[pos + 1], buf[pos + HEADER_LEN:packet_end - 1]))
+            pos = packet_end
+        if garbage:
+            self.garbage_bytes += garbage
+        if packets:
+            self.packets += len(packets)
+        if pos == end:
+            buf.clear()
+            pos = 0
+        elif pos >= self.compact_threshold:
+            del buf[:pos]
+            needed -= pos
+            pos = 0
+        self.offset = pos
+        self.needed = needed
+        return packets
+
+    def pending_bytes(self):
+        return len(self.buffer) - self.offset
@@ -0,0 +1,244 @@
+import asyncio
+import json
+import os
+import struct
+import threading
+import time
+import numpy as np
+
+# 比賽現場錄製與重播。
+# 每次錄製是一個資料夾：session.json (設定)、ble.bin (各 Hub 的 handle_rx 收到的原始通知) 與 frames.bin (鏡頭畫面)，
+# 兩個檔案都只會在尾端追加，時間戳記是相對於錄製開始的秒數。
+# frames.bin 是固定 64 位元組的檔頭加上等長的紀錄 (timestamp, seq, 原始畫面)，可以直接 np.memmap，不需要解碼。
+# 重播時 ReplayScanner / ReplayClient / ReplayCapture 取代藍牙與鏡頭，把同一段資料重新送過解析、推論與推播。
+
+FRAMES_MAGIC = b'WROFRM01'
+BLE_MAGIC = b'WROBLE02'
+HEADER_SIZE = 64
+FRAMES_HEADER = struct.Struct('<8sIII')
+# timestamp, Hub 在 session.json "hubs" 中的索引, 資料長度
+BLE_RECORD = struct.Struct('<dBH')
+FRAME_RECORD = struct.Struct('<dQ')
+
+def frame_record_dtype(shape):
+    return np.dtype([('timestamp', '<f8'), ('seq', '<u8'), ('image', np.uint8, tuple(shape))])
+
+class SessionRecorder:
+    def __init__(self, directory, meta=None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.started = time.monotonic()
+        self.meta = dict(meta or {}, started_at=time.time())
+        self.hubs = list(self.meta.get("hubs", []))
+        self.ble_file = open(os.path.join(directory, "ble.bin"), "ab")
+        if self.ble_file.tell() == 0:
+            self.ble_file.write(BLE_MAGIC.ljust(HEADER_SIZE, b'\0'))
+        self.frames_file = None
+        self.frame_shape = None
+        self.frames = 0
+        self.notifications = 0
+        self.lock = threading.Lock()
+        self.write_meta()
+
+    @classmethod
+    def create(cls, parent, meta=None):
+        return cls(os.path.join(parent, time.strftime("%Y%m%d-%H%M%S")), meta)
+
+    def write_meta(self):
+        with open(os.path.join(self.directory, "session.json"), "w", encoding="utf-8") as f:
+            json.dump(dict(self.meta, hubs=self.hubs, frame_shape=self.frame_shape), f, indent=2)
+
+    def record_ble(self, hub, data):
+        # 在事件迴圈上呼叫，只是一次有緩衝的寫入
+        if self.ble_file is None:
+            return
+        if hub not in self.hubs:
+            self.hubs.append(hub)
+            self.write_meta()
+        self.ble_file.write(BLE_RECORD.pack(time.monotonic() - self.started, self.hubs.index(hub), len(data)))
+        self.ble_file.write(data)
+        self.notifications += 1
+
+    def record_frame(self, seq, timestamp, image):
+        # 在鏡頭執行緒上呼叫，畫面整塊寫入，不做任何編碼
+        with self.lock:
+            if self.ble_file is None:
+                return
+            if self.frames_file is None:
+                self.frame_shape = list(image.shape)
+                self.frames_file = open(os.path.join(self.directory, "frames.bin"), "ab")
+                height, width = image.shape[:2]
+                channels = image.shape[2] if image.ndim > 2 else 1
+                self.frames_file.write(FRAMES_HEADER.pack(FRAMES_MAGIC, height, width, channels).ljust(HEADER_SIZE, b'\0'))
+                self.write_meta()
+            self.frames_file.write(FRAME_RECORD.pack(timestamp - self.started, seq))
+            self.frames_file.write(np.ascontiguousarray(image).data)
+            self.frames += 1
+
+    def close(self):
+        with self.lock:
+            if self.ble_file is None:
+                return
+            self.ble_file.close()
+            self.ble_file = None
+            if self.frames_file is not None:
+                self.frames_file.close()
+        print(f"錄製完成: {self.notifications} 筆藍牙通知、{self.frames} 幀畫面，存放於 '{self.directory}'。")
+
+def read_ble_log(path):
+    with open(path, "rb") as f:
+        if f.read(HEADER_SIZE)[:len(BLE_MAGIC)] != BLE_MAGIC:
+            raise ValueError(f"'{path}' 不是藍牙錄製檔")
+        records = []
+        while True:
+            header = f.read(BLE_RECORD.size)
+            if len(header) < BLE_RECORD.size:
+                break
+            timestamp, hub, length = BLE_RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                break
+            records.append((timestamp, hub, data))
+    return records
+
+def open_frames(path):
+    # 回傳唯讀的 memmap 紀錄陣列；錄製中途中斷時最後一筆不完整的紀錄會被忽略
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        magic, height, width, channels = FRAMES_HEADER.unpack(f.read(HEADER_SIZE)[:FRAMES_HEADER.size])
+    if magic != FRAMES_MAGIC:
+        raise ValueError(f"'{path}' 不是畫面錄製檔")
+    dtype = frame_record_dtype((height, width, channels))
+    count = (os.path.getsize(path) - HEADER_SIZE) // dtype.itemsize
+    if count == 0:
+        return None
+    return np.memmap(path, dtype=dtype, mode="r", offset=HEADER_SIZE, shape=(count,))
+
+class ReplaySession:
+    # realtime=False 時盡快重播：以最後讀到的畫面時間當作時鐘，藍牙通知仍然依照錄製時的順序穿插在畫面之間
+    def __init__(self, directory, realtime=False):
+        self.directory = directory
+        self.realtime = realtime
+        with open(os.path.join(directory, "session.json"), "r", encoding="utf-8") as f:
+            self.hubs = json.load(f).get("hubs", [])
+        self.notifications = read_ble_log(os.path.join(directory, "ble.bin"))
+        self.frames = open_frames(os.path.join(directory, "frames.bin"))
+        self.started = None
+        self.position = 0.0
+        self.frames_done = self.frames is None
+        self.hubs_done = set()
+        self.replies = []
+        # 清除後重播會暫停在開頭，讓 bench_replay 等模型載入完成再開始
+        self.running = threading.Event()
+        self.running.set()
+
+    @classmethod
+    def from_env(cls):
+        directory = os.environ.get("WRO_REPLAY_DIR")
+        if not directory:
+            return None
+        return cls(directory, realtime=os.environ.get("WRO_REPLAY_REALTIME", "0") == "1")
+
+    @property
+    def ble_done(self):
+        return len(self.hubs_done) >= len(self.hubs)
+
+    @property
+    def done(self):
+        return self.frames_done and self.ble_done
+
+    def now(self):
+        if self.started is None:
+            self.started = time.monotonic()
+        if self.realtime:
+            return time.monotonic() - self.started
+        return float('inf') if self.frames_done else self.position
+
+    def capture(self):
+        return ReplayCapture(self)
+
+    async def replay_ble(self, hub, callback):
+        while not self.running.is_set():
+            await asyncio.sleep(0.01)
+        index = self.hubs.index(hub)
+        for timestamp, record_hub, data in self.notifications:
+            if record_hub != index:
+                continue
+            while self.now() < timestamp:
+                await asyncio.sleep(min(0.005, timestamp - self.now()) if self.realtime else 0.001)
+            callback(None, bytearray(data))
+        self.hubs_done.add(hub)
+
+REPLAY = ReplaySession.from_env()
+
+class ReplayCapture:
+    # 介面與 cv2.VideoCapture 相同，依序讀出錄製的畫面，讀完後回傳 False 讓鏡頭執行緒結束
+    def __init__(self, session):
+        self.session = session
+        self.index = 0
+
+    def isOpened(self):
+        return self.session.frames is not None
+
+    def grab(self):
+        ret, _ = self.read()
+        return ret
+
+    def read(self, image=None):
+        frames = self.session.frames
+        if frames is None or self.index >= len(frames):
+            self.session.frames_done = True
+            return False, None
+        self.session.running.wait()
+        record = frames[self.index]
+        self.index += 1
+        timestamp = float(record['timestamp'])
+        if self.session.realtime:
+            delay = timestamp - self.session.now()
+            if delay > 0:
+                time.sleep(delay)
+        else:
+            self.session.now()
+            self.session.position = timestamp
+        if image is None or image.shape != record['image'].shape:
+            return True, np.array(record['image'])
+        np.copyto(image, record['image'])
+        return True, image
+
+    def release(self):
+        self.session.frames_done = True
+
+class ReplayDevice:
+    def __init__(self, name):
+        self.name = name
+        self.address = "replay"
+
+class ReplayScanner:
+    @staticmethod
+    async def find_device_by_name(name, timeout=5.0):
+        await asyncio.sleep(0)
+        return ReplayDevice(name) if REPLAY is not None and name in REPLAY.hubs else None
+
+class ReplayClient:
+    # 連線後依錄製的時間送出該 Hub 的通知；PC 回寫給 Hub 的資料記錄在 REPLAY.replies，重播結束後仍保持連線
+    def __init__(self, device):
+        self.device = device
+        self.task = None
+
+    @property
+    def is_connected(self):
+        return True
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def start_notify(self, char_uuid, callback):
+        self.task = asyncio.create_task(REPLAY.replay_ble(self.device.name, callback))
+
+    async def write_gatt_char(self, char_uuid, data, response=False):
+        REPLAY.replies.append((time.monotonic() - REPLAY.started, self.device.name, bytes(data)))
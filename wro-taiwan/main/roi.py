@@ -0,0 +1,61 @@
+import threading
+import numpy as np
+
+# 電池檢查區域 (ROI) 的裁切與 letterbox。
+# 縮放比例、補邊位置都在建立時算好，每個推論執行緒各有一塊預先配置的輸入緩衝區，
+# 推論時只做一次 cv2.resize 直接寫進緩衝區，偵測框再換算回原始畫面座標。
+
+LETTERBOX_FILL = 114
+
+def parse_roi(text):
+    if not text:
+        return None
+    x, y, w, h = (int(v) for v in text.split(','))
+    return (x, y, w, h)
+
+class RoiLetterbox:
+    def __init__(self, frame_shape, roi, imgsz):
+        frame_h, frame_w = frame_shape[:2]
+        self.requested_roi = roi
+        x, y, w, h = roi
+        x = min(max(0, x), frame_w - 1)
+        y = min(max(0, y), frame_h - 1)
+        self.roi = (x, y, min(w, frame_w - x), min(h, frame_h - y))
+        self.frame_shape = tuple(frame_shape)
+        self.imgsz = imgsz
+        _, _, w, h = self.roi
+        self.scale = min(imgsz / w, imgsz / h)
+        self.size = (max(1, round(w * self.scale)), max(1, round(h * self.scale)))
+        self.pad_x = (imgsz - self.size[0]) // 2
+        self.pad_y = (imgsz - self.size[1]) // 2
+        self._local = threading.local()
+
+    def _buffers(self, count):
+        buffers = getattr(self._local, "buffers", None)
+        if buffers is None or buffers.shape[0] < count:
+            channels = self.frame_shape[2] if len(self.frame_shape) > 2 else 1
+            buffers = np.full((count, self.imgsz, self.imgsz, channels), LETTERBOX_FILL, dtype=np.uint8)
+            self._local.buffers = buffers
+        return buffers
+
+    def prepare(self, frames):
+        # 回傳 (N, imgsz, imgsz, C) 的緩衝區視圖，內容在同一執行緒下一次呼叫前有效
+        import cv2
+        x, y, w, h = self.roi
+        buffers = self._buffers(len(frames))
+        for i, frame in enumerate(frames):
+            target = buffers[i, self.pad_y:self.pad_y + self.size[1], self.pad_x:self.pad_x + self.size[0]]
+            cv2.resize(frame[y:y + h, x:x + w], self.size, dst=target, interpolation=cv2.INTER_AREA)
+        return buffers[:len(frames)]
+
+    def map_back(self, detections):
+        x, y, _, _ = self.roi
+        mapped = []
+        for class_name, confidence, (x1, y1, x2, y2) in detections:
+            mapped.append((class_name, confidence, (
+                int((x1 - self.pad_x) / self.scale) + x,
+                int((y1 - self.pad_y) / self.scale) + y,
+                int((x2 - self.pad_x) / self.scale) + x,
+                int((y2 - self.pad_y) / self.scale) + y,
+            )))
+        return mapped
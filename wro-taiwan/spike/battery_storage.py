@@ -3,7 +3,8 @@ from pybricks.hubs import ThisHub
 from pybricks.pupdevices import Motor, ColorSensor
 from pybricks.parameters import Port, Color, Stop, Icon
 from pybricks.tools import wait
-import ujson
+from rpc import RpcServer
+from storage_format import encode_storage, USABLE_CHARGE
 
 CAR_ID = 198
 MAIN_ID = 179
@@ -26,12 +27,6 @@ storage = {
     Color.GREEN : [0, 0]
 }
 
-color_convert = {
-    Color.RED : "RED",
-    Color.BLUE : "BLUE",
-    Color.GREEN : 'GREEN',
-}
-
 speed_b = -250
 
 def go_color(motor, color_sensor, color, speed, step):
@@ -56,7 +51,7 @@ def find_empty(storage):
 
 def find_usable(storage):
     for key, item in storage.items():
-        if (item[0] == 1 and item[1]>=90):
+        if (item[0] == 1 and item[1]>=USABLE_CHARGE):
             storage[key][0] = 0
             storage[key][1] = 0
             return key
@@ -64,26 +59,7 @@ def find_usable(storage):
 def receive_command_sound():
     hub.speaker.beep(frequency=784, duration=250)  # G5 (中高音 Sol)
 
-def broadcast_json(hub, data_dict):
-    global color_convert
-
-    data = {color_convert[key]: value for key, value in data_dict.items()}
-    
-    json_string = ujson.dumps(data)
-    max_chunk_size = 18
-    chunks = [json_string[i:i + max_chunk_size] for i in range(0, len(json_string), max_chunk_size)]
-    total_chunks = len(chunks)
-
-    for i, chunk in enumerate(chunks):
-        message = f"D:{i+1}/{total_chunks}:{chunk}"
-        hub.ble.broadcast(message)
-        wait(250) # 延遲確保每個包都被對方接收到
-    
-    hub.ble.broadcast(None)
-
 def main():
-    global storage
-    last_command_processed = None
     step_b = 150 #ms
 
     F = 40
@@ -91,47 +67,45 @@ def main():
     motor_f.dc(F)
     # motor_e.dc(-100)
 
-    while True:
-        command = hub.ble.observe(MAIN_ID)
-
-        if command and command != last_command_processed:
-            last_command_processed = command
-
-            if command == "BATTERY_STORAGE":
-                receive_command_sound()
-                empty = find_empty(storage)
-                go_color(motor_b, color_sensor_c, empty, speed_b, step_b) # go to empty storage
-                hub.ble.broadcast("BATTERY_STORAGED")
-                
-            elif command == "BATTERY_REPLACE":
-                receive_command_sound()
-                usable = find_usable(storage)
-                go_color(motor_b, color_sensor_c, usable, speed_b, step_b) # go to usable storage
-                hub.ble.broadcast("BATTERY_REPLACED")
-            
-            elif command == "STOP_BATTERY_TRACK":
-                motor_f.dc(0)
-                hub.ble.broadcast("STOPED_BATTERY_TRACK")
-                
-            elif command == "START_BATTERY_TRACK":
-                motor_f.dc(F)
-                hub.ble.broadcast("STARTED_BATTERY_TRACK")
-
-            elif command == "BATTERY_CONVERT_RESET":
-                receive_command_sound()
-                storage = {
-                    Color.BLUE : [1, 60],
-                    Color.RED : [1, 95],
-                    Color.GREEN : [0, 0]
-                }
-                wait(step_b)
-                hub.ble.broadcast("BATTERY_CONVERT_RESETED")
-            elif command == "STORAGE_DATA":
-                broadcast_json(hub, storage)
-                receive_command_sound()
-
-
-        wait(100)
+    def on_storage():
+        receive_command_sound()
+        empty = find_empty(storage)
+        go_color(motor_b, color_sensor_c, empty, speed_b, step_b) # go to empty storage
+
+    def on_replace():
+        receive_command_sound()
+        usable = find_usable(storage)
+        go_color(motor_b, color_sensor_c, usable, speed_b, step_b) # go to usable storage
+
+    def on_stop_track():
+        motor_f.dc(0)
+
+    def on_start_track():
+        motor_f.dc(F)
+
+    def on_reset():
+        global storage
+        receive_command_sound()
+        storage = {
+            Color.BLUE : [1, 60],
+            Color.RED : [1, 95],
+            Color.GREEN : [0, 0]
+        }
+        wait(step_b)
+
+    def on_storage_data():
+        # colors 的順序和 storage_format.SLOTS 相同，狀態直接放在 RPC 回覆裡
+        receive_command_sound()
+        return encode_storage([storage[color] for color in colors])
+
+    RpcServer(hub, MAIN_ID, STORAGE_ID, {
+        "BATTERY_STORAGE": on_storage,
+        "BATTERY_REPLACE": on_replace,
+        "STOP_BATTERY_TRACK": on_stop_track,
+        "START_BATTERY_TRACK": on_start_track,
+        "BATTERY_RESET": on_reset, # 指令名稱受廣播長度限制
+        "STORAGE_DATA": on_storage_data,
+    }).serve()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,23 @@
+import ustruct
+
+# 手臂 Hub 的校正資料，存在 hub.system.storage (關機時寫入快閃記憶體)。
+# zero_*: 歸零時撞到的機構極限在目前座標中的角度；*_open / *_close: 開關兩端的角度；
+# last_*: 存檔當下的馬達角度。馬達以 reset_angle=False 建立，只要 Hub 沒有重新開機、機構沒被移動，
+# 下次啟動時讀到的角度會和 last_* 相同，校正就能沿用，只需要碰一下極限確認。
+
+CALIBRATION_VERSION = 1
+CALIBRATION_FIELDS = ("zero_A", "zero_C", "zero_E", "B_open", "B_close", "F_open", "F_close",
+                      "last_A", "last_B", "last_C", "last_E", "last_F")
+CALIBRATION_FORMAT = '<B' + 'i' * len(CALIBRATION_FIELDS)
+CALIBRATION_OFFSET = 0
+
+def load_calibration(hub):
+    values = ustruct.unpack(CALIBRATION_FORMAT, hub.system.storage(CALIBRATION_OFFSET, read=ustruct.calcsize(CALIBRATION_FORMAT)))
+    # 還沒存過時整塊都是 0，版本不符
+    if values[0] != CALIBRATION_VERSION:
+        return None
+    return dict(zip(CALIBRATION_FIELDS, values[1:]))
+
+def save_calibration(hub, calibration):
+    hub.system.storage(CALIBRATION_OFFSET, write=ustruct.pack(CALIBRATION_FORMAT, CALIBRATION_VERSION,
+                                                              *[int(calibration[name]) for name in CALIBRATION_FIELDS]))
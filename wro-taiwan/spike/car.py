@@ -2,15 +2,21 @@
 from pybricks.hubs import ThisHub
 from pybricks.pupdevices import Motor
 from pybricks.parameters import Port, Stop
-from pybricks.tools import wait
+from pybricks.tools import StopWatch
+from rpc import RpcServer
 
 CAR_ID = 198
 MAIN_ID = 179
+# 車上沒有到站感測器，到站與否以車子自己的狀態回報：開機時視為已到站等著換電池；
+# 手臂換完電池送 CAR_DONE 後車子離站，TURNAROUND ms 後才視為下一台車到站
+TURNAROUND = 8000
 
 hub = ThisHub(broadcast_channel=CAR_ID, observe_channels=[MAIN_ID])
 hub.speaker.volume(50)
 
 motor_b = Motor(Port.B)
+served = False
+turnaround = StopWatch()
 
 MOTOR_SPEED = 500
 DUTY_LIMIT = 75
@@ -27,27 +33,35 @@ def grab():
 def receive_command_sound():
     hub.speaker.beep(frequency=784, duration=250)
 
+def on_grab():
+    receive_command_sound()
+    grab()
+
+def on_drop():
+    receive_command_sound()
+    drop()
+
+def on_done():
+    global served
+    receive_command_sound()
+    served = True
+    turnaround.reset()
+
+def on_ready():
+    # 立刻回覆，不在 RPC 裡等待；還沒到站時手臂會隔一段時間再問
+    global served
+    if served and turnaround.time() >= TURNAROUND:
+        served = False
+    return not served
+
 def main():
     reset()
-    last_command_processed = None
-
-    while True:
-        command = hub.ble.observe(MAIN_ID)
-
-        if command and command != last_command_processed:
-            last_command_processed = command
-
-            if command == "CAR_GRAB":
-                receive_command_sound()
-                grab()
-                hub.ble.broadcast("CAR_GRABED")
-                
-            elif command == "CAR_DROP":
-                receive_command_sound()
-                drop()
-                hub.ble.broadcast("CAR_DROPPED")
-        
-        wait(100)
+    RpcServer(hub, MAIN_ID, CAR_ID, {
+        "CAR_GRAB": on_grab,
+        "CAR_DROP": on_drop,
+        "CAR_READY": on_ready,
+        "CAR_DONE": on_done,
+    }).serve()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
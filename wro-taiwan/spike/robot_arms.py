@@ -1,43 +1,50 @@
 from pybricks.hubs import ThisHub
 from pybricks.pupdevices import Motor
 from pybricks.parameters import Port, Stop, Button
-from pybricks.tools import wait, StopWatch
-import ujson
+from pybricks.tools import wait, StopWatch, run_task
 from usys import stdout, stdin 
-import ustruct    
 import uselect   
+import ustruct
+from rpc import RpcClient
+from steps import run_steps
+from trajectory import Trajectory
+from calibration import load_calibration, save_calibration
+from storage_format import SLOTS, HEADER_SIZE, USABLE_CHARGE, slot_count, describe_storage, find_slot
 
 PACKET_TYPE_STORAGE = b'\x01'
 PACKET_TYPE_COMMAND = b'\x02'
 PACKET_TYPE_LOG = b'\x03'
+PACKET_TYPE_STATS = b'\x04'
 
 CAR_ID = 198
 MAIN_ID = 179 
 STORAGE_ID = 147
 DEBUG = True
+# 連續模式: 歸零一次後持續換電池，每一輪開始前等車子回報到站，直到電池倉沒有可替換的電池或沒有空位
+CONTINUOUS = False
+# 車子還沒到站時隔多久再問一次 (ms)，每次加倍到上限，不讓 CAR_READY 一直佔住廣播頻道
+READY_POLL_MIN = 500
+READY_POLL_MAX = 4000
+# 連續模式每隔幾輪讓 A、C 碰一次機構極限重新歸零，消除每輪重設座標累積的偏移
+REHOME_CYCLES = 5
+# 沿用校正時，先快速移到離機構極限 VERIFY_MARGIN 度的地方，再以 VERIFY_SPEED 碰一下極限；
+# 碰到的角度和校正值差超過 VERIFY_TOLERANCE 度就視為偏移，改為完整歸零
+VERIFY_MARGIN = 40
+VERIFY_SPEED = 180
+VERIFY_TOLERANCE = 15
+# 移到極限前超過正常移動時間兩倍再加 VERIFY_TIMEOUT ms 還沒到，視為卡住，改為完整歸零
+VERIFY_TIMEOUT = 1000
+# 開機時馬達角度和上次存檔時差超過這個值，表示 Hub 重新開機過或機構被移動過，校正不能沿用
+CALIBRATION_DRIFT = 10
 
 hub = ThisHub(broadcast_channel=MAIN_ID, observe_channels=[CAR_ID, STORAGE_ID])
 hub.ble.broadcast(None)
 hub.speaker.volume(70)
-watch = StopWatch()
+rpc = RpcClient(hub)
+inspect_request_id = 0
+storage_packet = bytearray(b'>' + PACKET_TYPE_STORAGE + bytes([2 * len(SLOTS)]) + bytes(2 * len(SLOTS)) + b'<')
 
 
-def reconstruct_and_cleanup(hub, chunks):
-    if not chunks:
-        debug("Error: No data chunks to reconstruct.")
-        hub.speaker.beep(262, 500)
-        return None
-    try:
-        total = max(chunks.keys())
-        full_str = "".join(chunks.get(i, "") for i in range(1, total + 1))
-        parsed = ujson.loads(full_str)
-        
-        hub.speaker.beep(1047, 200)
-        return parsed
-    except Exception as e:
-        debug(f"Error: Failed to reconstruct data. Details: {e}")
-        hub.speaker.beep(262, 500)
-        return None
 def send_packet_to_pc(packet_type, payload):
     try:
         if not isinstance(payload, bytes):
@@ -51,395 +58,456 @@ def send_packet_to_pc(packet_type, payload):
 def debug(string):
     if DEBUG:
         send_packet_to_pc(PACKET_TYPE_LOG, string)
-def wait_for_ai_result(timeout=10000):
+async def wait_for_ai_result(timeout=10000, retry_interval=2000):
+    global inspect_request_id
+    inspect_request_id = inspect_request_id % 999 + 1
+    request_id = str(inspect_request_id)
     poller = uselect.poll()
     poller.register(stdin, uselect.POLLIN)
 
-    send_packet_to_pc(PACKET_TYPE_COMMAND, b'INSPECT')
-    send_command_sound()
+    send_packet_to_pc(PACKET_TYPE_COMMAND, 'INSPECT:' + request_id)
+    await send_command_sound()
     
-    watch.reset()
-    debug("已發送辨識請求，開始輪詢結果...")
+    watch = StopWatch()
+    last_request = 0
+    debug(f"已發送辨識請求 {request_id}，等待 PC 推送結果...")
 
     while watch.time() < timeout:
-        send_packet_to_pc(PACKET_TYPE_COMMAND, b'RDY_FOR_RESULT')
-        
-        poll_watch = StopWatch()
-        while poll_watch.time() < 250:
-            if poller.poll(10): 
-                result = stdin.readline().strip()
-                if result:
-                    receive_command_sound()
-                    debug(f"成功收到結果-> {result}")
-                    return result 
-            wait(10)
-        
+        # PC 辨識完會主動推送 "<id>:<結果>"；不阻塞在 stdin 上，等待期間其他步驟可以繼續執行
+        if poller.poll(0):
+            line = stdin.readline().strip()
+            reply_id, _, result = line.partition(':')
+            if reply_id == request_id and result:
+                await receive_command_sound()
+                debug(f"成功收到結果-> {result}")
+                return result
+            # 其他 ID 是之前請求的回應，直接丟掉
+            continue
+        if watch.time() - last_request >= retry_interval:
+            # 太久沒收到推送，可能是回應遺失，請 PC 重送一次
+            last_request = watch.time()
+            send_packet_to_pc(PACKET_TYPE_COMMAND, 'RDY_FOR_RESULT:' + request_id)
+        await wait(10)
 
     debug("等待 AI 結果超時。")
     return "TIMEOUT"
-def call_storage_data(hub, watch, request_command="STORAGE_DATA", timeout=5000):
-    hub.ble.broadcast(request_command)
-    chunks = {}
-    expected_total_chunks = None
-    watch.reset()
-
-    while watch.time() < timeout:
-        data = hub.ble.observe(STORAGE_ID)
-        if not data:
-            wait(10)
-            continue
-
-        if isinstance(data, str) and data.startswith('D:'):
-            try:
-                _, header, payload = data.split(':', 2)
-                current, total = map(int, header.split('/'))
-                
-                if expected_total_chunks is None:
-                    expected_total_chunks = total
-                
-                if current not in chunks:
-                    chunks[current] = payload
-
-                if len(chunks) == expected_total_chunks:
-                    return reconstruct_and_cleanup(hub, chunks)
-
-            except (ValueError, IndexError):
-                pass 
-
-    debug("Timeout: Did not receive a complete response.")
-    hub.speaker.beep(349, 700)
-    hub.ble.broadcast(None)
-    return None
-def send_storage_to_pc(storage_dict):
-    if not storage_dict:
+async def call_storage_data(request_command="STORAGE_DATA", timeout=2000):
+    data = await rpc.call(STORAGE_ID, request_command, timeout=timeout)
+    if not slot_count(data):
+        debug("Timeout: Did not receive a valid storage status.")
+        await hub.speaker.beep(349, 700)
+        return None
+    await hub.speaker.beep(1047, 200)
+    return data
+def send_storage_to_pc(data):
+    # 電池倉回覆的槽位資料直接複製進預先配置好的封包，不產生新的物件
+    count = slot_count(data)
+    if not count:
         return
-
-    color_order = ["BLUE", "RED", "GREEN"]
-    data_to_pack = []
-    for color in color_order:
-        has_battery, charge = storage_dict.get(color, [0, 0])
-        data_to_pack.append(has_battery)
-        data_to_pack.append(charge)
-    
-    payload = ustruct.pack('>BBBBBB', *data_to_pack)
-    send_packet_to_pc(PACKET_TYPE_STORAGE, payload)
-def rst(motor, base, speed=-720, duty_limit=50):
-    motor.run_until_stalled(speed, then=Stop.HOLD, duty_limit=duty_limit)
+    for i in range(2 * len(SLOTS)):
+        storage_packet[3 + i] = data[HEADER_SIZE + i] if i < 2 * count else 0
+    stdout.buffer.write(storage_packet)
+async def touch(motor, expected, speed, duty_limit):
+    direction = 1 if speed > 0 else -1
+    target = expected - direction * VERIFY_MARGIN
+    timeout = abs(target - motor.angle()) * 2000 // abs(speed) + VERIFY_TIMEOUT
+    # 校正值已經不準時，可能還沒到目標就撞上極限，run_target 會一直等不到完成
+    await motor.run_target(abs(speed), target, wait=False)
+    watch = StopWatch()
+    while not motor.done():
+        if motor.stalled() or watch.time() > timeout:
+            motor.stop()
+            debug("移到極限前就卡住，重新歸零。")
+            return False
+        await wait(10)
+    await motor.run_until_stalled(direction * VERIFY_SPEED, then=Stop.HOLD, duty_limit=duty_limit)
+    drift = motor.angle() - expected
+    if abs(drift) > VERIFY_TOLERANCE:
+        debug(f"校正偏移 {drift} 度，重新歸零。")
+        return False
+    return True
+async def rst(motor, base, speed=-720, duty_limit=50, expected=None):
+    # expected: 上次校正時機構極限的角度，確認沒有偏移就不必從遠處一路撞過去
+    if expected is None or not await touch(motor, expected, speed, duty_limit):
+        await motor.run_until_stalled(speed, then=Stop.HOLD, duty_limit=duty_limit)
     motor.reset_angle(0)
     if base != 0:
-        motor.run_target(speed, base)
+        await motor.run_target(speed, base)
     return base
-def rst_switch(motor, time = 500, speed=720, duty_limit=50):
-    motor.run_until_stalled(speed, then=Stop.HOLD, duty_limit=duty_limit)
+async def rst_switch(motor, time = 500, speed=720, duty_limit=50, expected=None):
+    # expected: 上次量到的兩端 (小, 大)；碰一下歸零最後停的那一端，沒有偏移就沿用，不再來回撞兩次
+    if expected is not None and await touch(motor, expected[0] if speed > 0 else expected[1], -speed, duty_limit):
+        return expected
+    await motor.run_until_stalled(speed, then=Stop.HOLD, duty_limit=duty_limit)
     a = motor.angle()
-    wait(time)
-    motor.run_until_stalled(-speed, then=Stop.HOLD, duty_limit=duty_limit)
+    await wait(time)
+    await motor.run_until_stalled(-speed, then=Stop.HOLD, duty_limit=duty_limit)
     b = motor.angle()
-    wait(time)
+    await wait(time)
     if (a<b):
         return a, b;
     else:
         return b, a;
-def switch(motor, open_p, close_p, status, speed = 720, duty_limit = 100):
+async def switch(motor, open_p, close_p, status, speed = 720, duty_limit = 100):
     if status:
-        motor.run_until_stalled(status*speed, then=Stop.HOLD, duty_limit=duty_limit)
+        await motor.run_until_stalled(status*speed, then=Stop.HOLD, duty_limit=duty_limit)
     else:
-        motor.run_until_stalled(-speed*status, then=Stop.HOLD, duty_limit=duty_limit)
+        await motor.run_until_stalled(-speed*status, then=Stop.HOLD, duty_limit=duty_limit)
     return (-status)
-def go_hold(motor, time, mid, speed = 720):
-    wait(time)
-    motor.run_target(speed, mid)
-def turn_switch(motor, open_p, mid_p, close_p, time, nxt, status, speed = 720):
-    n = switch(motor, open_p, close_p, status, speed = speed)
-    go_hold(motor, time, mid_p, speed = speed)
-    wait(nxt)
+async def go_hold(motor, time, mid, speed = 720):
+    await wait(time)
+    await motor.run_target(speed, mid)
+async def turn_switch(motor, open_p, mid_p, close_p, time, nxt, status, speed = 720):
+    n = await switch(motor, open_p, close_p, status, speed = speed)
+    await go_hold(motor, time, mid_p, speed = speed)
+    await wait(nxt)
     return n
 def get_base_speed(goal, cur):
     return ((goal-cur)/30)
-def work_motor(motor, goal, speed = 360):
+async def work_motor(motor, goal, speed = 360):
     motor.run_target(speed, goal, wait = False)
     while(not motor.done()):
-        wait(10)
-def work_motor_double(motor_a, goal_a, motor_b, goal_b):
-    dist_b = abs(motor_b.angle()-goal_b)
-    dist_a = abs(motor_a.angle()-goal_a)
-    if(dist_b > 0):
-        motor_a.run_target(360/dist_b*dist_a, goal_a, wait = False)
-    else:
-        motor_a.run_target(360, goal_a, wait = False)
-    motor_b.run_target(360, goal_b, wait = False)
-    while not motor_a.done() or not motor_b.done():
-        wait(10)
-def reset_sound():
+        await wait(10)
+async def reset_sound():
     for i in range(3):
-        hub.speaker.beep(frequency=614, duration=230)
-        wait(350)
-def storage_sound():
-    hub.speaker.beep(frequency=523, duration=80)
-    wait(80)
-    hub.speaker.beep(frequency=659, duration=80)
-    wait(80)
-    hub.speaker.beep(frequency=784, duration=150)
-def drop_sound():
-    hub.speaker.beep(frequency=131, duration=500)
-def send_command_sound():
-    hub.speaker.beep(frequency=523, duration=200)
-def receive_command_sound():
-    hub.speaker.beep(frequency=784, duration=250)
-def check_receive_sound():
-    hub.speaker.beep(frequency=1047, duration=150)
-def main():
+        await hub.speaker.beep(frequency=614, duration=230)
+        await wait(350)
+async def storage_sound():
+    await hub.speaker.beep(frequency=523, duration=80)
+    await wait(80)
+    await hub.speaker.beep(frequency=659, duration=80)
+    await wait(80)
+    await hub.speaker.beep(frequency=784, duration=150)
+async def drop_sound():
+    await hub.speaker.beep(frequency=131, duration=500)
+async def send_command_sound():
+    await hub.speaker.beep(frequency=523, duration=200)
+async def receive_command_sound():
+    await hub.speaker.beep(frequency=784, duration=250)
+async def check_receive_sound():
+    await hub.speaker.beep(frequency=1047, duration=150)
+async def main():
 
-    motor_A = Motor(Port.A)
-    motor_B = Motor(Port.B)
-    motor_C = Motor(Port.C)
+    # 不重設角度，沿用上次程式結束時的座標
+    motor_A = Motor(Port.A, reset_angle=False)
+    motor_B = Motor(Port.B, reset_angle=False)
+    motor_C = Motor(Port.C, reset_angle=False)
     motor_D = Motor(Port.D)
-    motor_E = Motor(Port.E)
-    motor_F = Motor(Port.F)
+    motor_E = Motor(Port.E, reset_angle=False)
+    motor_F = Motor(Port.F, reset_angle=False)
     
     pos_A = 0; pos_C = 0; pos_E = 0
     base_A = 80+422; statu_B = 1; base_C = -624; power_D = 100; base_E = 10; statu_F = -1
     B_open, B_close, B_mid, F_open, F_close, F_mid = None, None, None, None, None, None
     storage_status = None
     reset_A = False; reset_B = False; reset_C = False; reset_E = False; reset_F = False
+    zero_A = 0; zero_C = 0; zero_E = 0
+
+    calibration = load_calibration(hub)
+    if calibration is not None:
+        for motor, name in ((motor_A, "last_A"), (motor_B, "last_B"), (motor_C, "last_C"), (motor_E, "last_E"), (motor_F, "last_F")):
+            if abs(motor.angle() - calibration[name]) > CALIBRATION_DRIFT:
+                debug("馬達角度和上次結束時不同，完整歸零。")
+                calibration = None
+                break
+    def saved(*names):
+        if calibration is None:
+            return None
+        return calibration[names[0]] if len(names) == 1 else tuple(calibration[name] for name in names)
+    def store_calibration():
+        if not (reset_A and reset_B and reset_C and reset_E and reset_F):
+            return
+        save_calibration(hub, {
+            "zero_A": zero_A, "zero_C": zero_C, "zero_E": zero_E,
+            "B_open": B_open, "B_close": B_close, "F_open": F_open, "F_close": F_close,
+            "last_A": motor_A.angle(), "last_B": motor_B.angle(), "last_C": motor_C.angle(),
+            "last_E": motor_E.angle(), "last_F": motor_F.angle(),
+        })
 
     motor_D.dc(power_D)
+
+    # 各軸速度上限與常用姿勢，只在開機時算一次
+    trajectory = Trajectory(((motor_A, 360), (motor_C, 360), (motor_E, 720), (motor_B, 720), (motor_F, 720)))
+    for ka, kc in ((1, 1), (0.98, 0.98), (1.01, 1.07)):
+        trajectory.add_pose(("base", ka, kc), ((motor_A, base_A*ka), (motor_C, base_C*kc)))
+    trajectory.add_pose("temp", ((motor_A, base_A+320), (motor_C, base_C+270)))
+    trajectory.add_pose("move", ((motor_A, base_A+250), (motor_C, base_C-90)))
+    for k in (0, 25):
+        trajectory.add_pose(("storage", k), ((motor_A, base_A+250), (motor_C, base_C-(170+k))))
+    trajectory.add_pose("check", ((motor_A, base_A-330), (motor_C, base_C+280)))
+    trajectory.add_pose("drop", ((motor_A, base_A+410), (motor_C, base_C-480)))
+    trajectory.add_pose("bed_storage", ((motor_E, 1650),))
+    trajectory.add_pose("bed_drop", ((motor_E, 0),))
+    trajectory.add_pose("bed_car", ((motor_E, 640),))
     
-    def rst_A():
-        nonlocal pos_A, reset_A
-        pos_A = rst(motor_A, base_A, duty_limit=100)
+    async def rst_A(expected=None):
+        nonlocal pos_A, reset_A, zero_A
+        pos_A = await rst(motor_A, base_A, duty_limit=100, expected=expected)
+        zero_A = 0
         reset_A = True
-    def rst_B():
+    async def rst_B():
         nonlocal B_open, B_close, B_mid, reset_B
-        B_open, B_close = rst_switch(motor_B, time=100, speed=900, duty_limit=200)
+        B_open, B_close = await rst_switch(motor_B, time=100, speed=900, duty_limit=200, expected=saved("B_open", "B_close"))
         B_mid = (B_open+B_close)/2
-        go_hold(motor_B, 0, B_mid)
+        await go_hold(motor_B, 0, B_mid)
         reset_B = True
-    def rst_C():
-        nonlocal pos_C, reset_C
+    async def rst_C(expected=None):
+        nonlocal pos_C, reset_C, zero_C
         offset = 30
-        pos_C = rst(motor_C, base_C-offset, speed=330, duty_limit=50)
-        work_motor(motor_C, base_C+offset, speed=180)
+        pos_C = await rst(motor_C, base_C-offset, speed=330, duty_limit=50, expected=expected)
+        await work_motor(motor_C, base_C+offset, speed=180)
         motor_C.reset_angle(base_C)
+        # 從另一側回到 base_C 才重設座標，極限在新座標中是 -offset
+        zero_C = -offset
         reset_C = True
-    def rst_E():
-        nonlocal pos_E, reset_E
-        pos_E = rst(motor_E, base_E, speed = -720, duty_limit=100)
+    async def rst_E():
+        nonlocal pos_E, reset_E, zero_E
+        pos_E = await rst(motor_E, base_E, speed = -720, duty_limit=100, expected=saved("zero_E"))
+        zero_E = 0
         reset_E = True
-    def rst_F():
+    async def rst_F():
         nonlocal F_open, F_close, F_mid, reset_F
-        F_open, F_close = rst_switch(motor_F, time = 50, speed=-720, duty_limit=200)
+        F_open, F_close = await rst_switch(motor_F, time = 50, speed=-720, duty_limit=200, expected=saved("F_open", "F_close"))
         F_mid = (F_open+F_close)/2
-        go_hold(motor_F, 0, F_mid)
+        await go_hold(motor_F, 0, F_mid)
         reset_F = True
-    def go_base_position_arm(ka = 1, kc = 1):
+    async def go_base_position_arm(ka = 1, kc = 1):
+        nonlocal zero_A, zero_C
         if not reset_A or not reset_C: raise SystemExit()
-        work_motor_double(motor_A, base_A*ka, motor_C, base_C*kc)
+        await trajectory.move(("base", ka, kc))
+        # 重設座標後機構極限的角度跟著平移
+        zero_A += base_A - motor_A.angle()
+        zero_C += base_C - motor_C.angle()
         motor_A.reset_angle(base_A)
         motor_C.reset_angle(base_C)
-    def go_temp_position_arm(offset_A = 320, offset_C = -270):
+    async def go_temp_position_arm():
         if not reset_A or not reset_C: raise SystemExit()
-        work_motor_double(motor_A, (base_A+offset_A), motor_C, (base_C-offset_C))
-    def go_move_position_arm(offset_A = 250, offset_C = 90):
+        await trajectory.move("temp")
+    async def go_move_position_arm():
         if not reset_A or not reset_C: raise SystemExit()
-        work_motor_double(motor_A, (base_A+offset_A), motor_C, (base_C-offset_C))
-    def go_storage_position_arm(offset_A = 250, offset_C = 170):
+        await trajectory.move("move")
+    async def go_storage_position_arm(k = 0):
         if not reset_A or not reset_C: raise SystemExit()
-        work_motor_double(motor_A, base_A+offset_A, motor_C, base_C-offset_C)
-    def go_check_position_arm(offset_A = -330, offset_C = -280):
+        await trajectory.move(("storage", k))
+    async def go_check_position_arm():
         if not reset_A or not reset_C: raise SystemExit()
-        work_motor(motor_A, base_A+offset_A, speed=360)
-        work_motor(motor_C, base_C-offset_C, speed=360)
-    def go_drop_position_arm():
+        await trajectory.move("check")
+    async def go_drop_position_arm():
         if not reset_A or not reset_C: raise SystemExit()
-        work_motor_double(motor_A, base_A+410, motor_C, base_C-480)
-    def go_storage_position_bed():
+        await trajectory.move("drop")
+    async def go_storage_position_bed():
         if not reset_E: raise SystemExit()
-        work_motor(motor_E, 1650, speed = 720)
-    def go_drop_position_bed():
+        await trajectory.move("bed_storage")
+    async def go_drop_position_bed():
         if not reset_E: raise SystemExit()
-        work_motor(motor_E, 0, speed=720)
-    def go_car_position_bed(goal = 640):
+        await trajectory.move("bed_drop")
+    async def go_car_position_bed():
         if not reset_E: raise SystemExit()
-        work_motor(motor_E, goal, speed=720)    
-    def turn_B():
+        await trajectory.move("bed_car")
+    async def turn_B():
         nonlocal statu_B
         if not reset_B: raise SystemExit()
-        statu_B = turn_switch(motor_B, B_open, B_mid, B_close, 500, 1000, statu_B)
-    def turn_F():   
+        statu_B = await turn_switch(motor_B, B_open, B_mid, B_close, 500, 1000, statu_B)
+    async def turn_F():   
         nonlocal statu_F
         if not reset_F: raise SystemExit()
-        statu_F = turn_switch(motor_F, F_open, F_mid, F_close, 1000, 1000, statu_F)
-    def reset_all(time = 0):
-        rst_E()
-        go_car_position_bed()
-        rst_A()
-        rst_C()
-        rst_B()
-        rst_F()
-        wait(time)
-        reset_sound()
-    def base_position(ka, kc):
-        go_move_position_arm()
-        go_car_position_bed()
-        go_base_position_arm(ka, kc)
-    def call_grab(command = "CAR_GRAB", check = "CAR_GRABED"):
-        hub.ble.broadcast(command)
-        while True:
-            if hub.ble.observe(CAR_ID) == check:
-                hub.ble.broadcast(None)
-                check_receive_sound()
-                break
-            wait(100)
-    def call_drop(command = "CAR_DROP", check = "CAR_DROPPED"):
-        hub.ble.broadcast(command)
-        while True:
-            if hub.ble.observe(CAR_ID) == check:
-                hub.ble.broadcast(None)
-                check_receive_sound()
-                break
-            wait(100)
-    def call_storage(command = "BATTERY_STORAGE", check = "BATTERY_STORAGED"):
-        hub.ble.broadcast(command)
-        while True:
-            if hub.ble.observe(STORAGE_ID) == check:
-                hub.ble.broadcast(None)
-                check_receive_sound()
-                break
-            wait(100)
-    def call_replace(command = "BATTERY_REPLACE", check = "BATTERY_REPLACED"):
-        hub.ble.broadcast(command)
-        while True:
-            if hub.ble.observe(STORAGE_ID) == check:
-                hub.ble.broadcast(None)
-                check_receive_sound()
-                break
-            wait(100)
-    def call_battery_convert_reset(command = "BATTERY_CONVERT_RESET", check = "BATTERY_CONVERT_RESETED"):
-        hub.ble.broadcast(command)
-        while True:
-            if hub.ble.observe(STORAGE_ID) == check:
-                hub.ble.broadcast(None)
-                check_receive_sound()
-                break
-            wait(100)
-    def call_stop_track(command = "STOP_BATTERY_TRACK", check = "STOPED_BATTERY_TRACK"):
-        hub.ble.broadcast(command)
-        while True:
-            if hub.ble.observe(STORAGE_ID) == check:
-                hub.ble.broadcast(None)
-                check_receive_sound()
-                break
-            wait(100)
-    def call_start_track(command = "START_BATTERY_TRACK", check = "STARTED_BATTERY_TRACK"):
-        hub.ble.broadcast(command)
-        while True:
-            if hub.ble.observe(STORAGE_ID) == check:
-                hub.ble.broadcast(None)
-                check_receive_sound()
-                break
-            wait(100)
-    def check():
-        go_temp_position_arm()
-        go_check_position_arm()
-        go_drop_position_bed()
-
-        battery_state = True
+        statu_F = await turn_switch(motor_F, F_open, F_mid, F_close, 1000, 1000, statu_F)
+    async def reset_all(time = 0):
+        await rst_E()
+        await go_car_position_bed()
+        await rst_A(saved("zero_A"))
+        await rst_C(saved("zero_C"))
+        await rst_B()
+        await rst_F()
+        store_calibration()
+        await wait(time)
+        await reset_sound()
+    async def rehome_arm():
+        # go_base_position_arm 每輪都以比例修正後的位置重設 A、C 座標，誤差會一輪輪累積；
+        # 車子離站時碰一次機構極限，座標回到真正的零點
+        debug("重新歸零手臂。")
+        await rst_A(zero_A)
+        await rst_C(zero_C)
+        store_calibration()
+    async def base_position(ka, kc):
+        await go_move_position_arm()
+        await go_car_position_bed()
+        await go_base_position_arm(ka, kc)
+    async def call_hub(target, command):
+        # 對方沒有回應就停下來，不要在車子或電池倉沒動作的情況下繼續移動手臂
+        if await rpc.call(target, command) is None:
+            debug(f"{command} 沒有回應，停止執行。")
+            raise SystemExit()
+        await check_receive_sound()
+    async def call_grab():
+        await call_hub(CAR_ID, "CAR_GRAB")
+    async def call_drop():
+        await call_hub(CAR_ID, "CAR_DROP")
+    async def call_storage():
+        await call_hub(STORAGE_ID, "BATTERY_STORAGE")
+    async def call_replace():
+        await call_hub(STORAGE_ID, "BATTERY_REPLACE")
+    async def call_battery_convert_reset():
+        await call_hub(STORAGE_ID, "BATTERY_RESET")
+    async def call_stop_track():
+        await call_hub(STORAGE_ID, "STOP_BATTERY_TRACK")
+    async def call_start_track():
+        await call_hub(STORAGE_ID, "START_BATTERY_TRACK")
+    async def call_done():
+        await call_hub(CAR_ID, "CAR_DONE")
+    async def wait_for_car():
+        # 車子到站前 CAR_READY 會回覆 False (或逾時)，一直問到回覆 True 為止
+        debug("等待車子到站...")
+        interval = READY_POLL_MIN
+        while not await rpc.call(CAR_ID, "CAR_READY"):
+            await wait(interval)
+            interval = min(interval * 2, READY_POLL_MAX)
+        await check_receive_sound()
+    async def report_storage_status(label):
+        nonlocal storage_status
+        storage_status = await call_storage_data()
+        if storage_status:
+            send_storage_to_pc(storage_status)
+            debug(f"{label}: {describe_storage(storage_status)}")
+    async def check():
+        # 鏡頭要拍到手臂上的電池，收到辨識結果之前手臂和床台都不動
+        await go_temp_position_arm()
+        await go_check_position_arm()
+        await go_drop_position_bed()
 
-        ai_result = wait_for_ai_result()
+        ai_result = await wait_for_ai_result()
 
-        if ai_result == "DIRTY":
-            battery_state = False
-            debug("AI 辨識-> 髒污，執行回收。")
-        elif ai_result == "CLEAN":
-            battery_state = True
+        # 只有明確回覆 OK 才收進電池倉；超時或看不懂的回覆都當作髒污回收，不把沒檢查過的電池裝回車上
+        battery_state = ai_result == "OK"
+        if battery_state:
             debug("AI 辨識-> 乾淨")
+        elif ai_result == "DIRTY":
+            debug("AI 辨識-> 髒污，執行回收。")
+        elif ai_result == "TIMEOUT":
+            debug("AI 辨識-> 超時，視為髒污，執行回收。")
         else:
-            debug("AI 辨識-> 超時")
-        go_car_position_bed()
-        go_temp_position_arm()
-        go_move_position_arm()
+            debug(f"AI 辨識-> 無法辨識的回覆 {ai_result}，視為髒污，執行回收。")
+        await go_car_position_bed()
+        await go_temp_position_arm()
+        await go_move_position_arm()
 
         return battery_state
-    def recycle():
-        go_drop_position_bed()
-        call_stop_track()
-        go_drop_position_arm()
-        turn_B()
-        go_move_position_arm()
-        call_start_track()
-    def grab():
-        turn_F()
-        call_drop()
-        turn_B()
-        wait(1000)
-        turn_F()
-        call_grab()
-    def storage():
-        call_storage()
-        go_storage_position_bed()
-        turn_F()
-        go_storage_position_arm()
-        turn_B()
-        turn_F()
+    async def recycle():
+        # 輸送帶停下來和床台移動同時進行，放下電池後輸送帶重新啟動和手臂離開同時進行
+        await run_steps([
+            ("bed", (), go_drop_position_bed),
+            ("stop_track", (), call_stop_track),
+            ("arm_drop", ("bed",), go_drop_position_arm),
+            ("release", ("arm_drop", "stop_track"), turn_B),
+            ("arm_move", ("release",), go_move_position_arm),
+            ("start_track", ("release",), call_start_track),
+        ])
+    async def grab():
+        await turn_F()
+        await call_drop()
+        await turn_B()
+        await wait(1000)
+        await turn_F()
+        # 電池已經離開車子，車子鎖回去的同時手臂先往上移
+        await run_steps([
+            ("car_grab", (), call_grab),
+            ("arm_temp", (), go_temp_position_arm),
+            ("arm_move", ("arm_temp",), go_move_position_arm),
+        ])
+    async def put_in_storage():
+        await turn_F()
+        await go_storage_position_arm()
+        await turn_B()
+        await turn_F()
+    async def storage():
+        # 電池倉轉到空位的同時床台移到電池倉；電池倉在收到指令時就更新狀態，轉完即可讀取
+        await run_steps([
+            ("carousel", (), call_storage),
+            ("bed", (), go_storage_position_bed),
+            ("put", ("carousel", "bed"), put_in_storage),
+            ("status", ("carousel",), lambda: report_storage_status("Status after storage")),
+        ])
+    async def take_from_storage():
+        await wait(1000)
+        await turn_F()
+        await turn_B()
+        await go_move_position_arm()
+    async def go_car(ka, kc):
+        await turn_F()
+        await go_car_position_bed()
+        await go_temp_position_arm()
+        await go_base_position_arm(ka, kc)
+    async def replace(ka, kc, k):
+        # 車子在收舊電池時就已經打開了
+        await run_steps([
+            ("arm_move", (), go_move_position_arm),
+            ("carousel", (), call_replace),
+            ("bed", ("arm_move",), go_storage_position_bed),
+            ("arm_storage", ("bed", "carousel"), lambda: go_storage_position_arm(k)),
+            ("take", ("arm_storage",), take_from_storage),
+            ("status", ("carousel",), lambda: report_storage_status("Storage status updated")),
+            ("go_car", ("take",), lambda: go_car(ka, kc)),
+        ])
+        await turn_F()
+        await call_grab()
+        await turn_B()
+        await turn_F()
+    async def cycle():
+        await grab()
+        battery_state = await check()  
 
-        storage_status = call_storage_data(hub, watch)
-        if storage_status:
-            send_storage_to_pc(storage_status)
-            debug(f"Status after storage: {str(storage_status)}")
+        # 舊電池已經離開車子，收進電池倉 (或回收) 的同時先打開車子準備接新電池
+        await run_steps([
+            ("store", (), storage if battery_state else recycle),
+            ("car_drop", (), call_drop),
+        ])
+        await base_position(0.98, 0.98)
 
-    def replace(ka, kc, k):
-        nonlocal storage_status
-        go_move_position_arm()
-        call_replace()
-        go_storage_position_bed()
-        go_storage_position_arm(offset_C=(170+k))
-        wait(1000)
-        turn_F()
-        turn_B()
-        go_move_position_arm()
-        
-        storage_status = call_storage_data(hub, watch)
-        if storage_status:
-            send_storage_to_pc(storage_status)
-            debug(f"Storage status updated: {str(storage_status)}")
-
-        turn_F()
-        go_car_position_bed()
-        go_temp_position_arm()
-        go_base_position_arm(ka, kc)
-        call_drop()
-        turn_F()
-        call_grab()
-        turn_B()
-        turn_F()
-    def process():
+        await replace(1.01, 1.07, 25)
+        # 車子換好電池，離站後才會再回報到站
+        await call_done()
+    def can_continue():
+        # 電池倉狀態沿用上一輪讀到的，下一輪要有空位收舊電池，也要有電量夠的電池可以換
+        if storage_status is None:
+            debug("讀不到電池倉狀態，停止連續模式。")
+            return False
+        if find_slot(storage_status, 0) < 0 or find_slot(storage_status, 1, USABLE_CHARGE) < 0:
+            debug(f"電池倉沒有空位或可替換的電池，停止連續模式: {describe_storage(storage_status)}")
+            return False
+        return True
+    async def process():
 
-        nonlocal storage_status
-        reset_all(3000)
-        
-        call_battery_convert_reset()
-        storage_status = call_storage_data(hub, watch)
-        if storage_status:
-            send_storage_to_pc(storage_status)
-            debug(f"Initial storage status: {str(storage_status)}")
-        
-        grab()
-        go_temp_position_arm()
-        go_move_position_arm()
-        battery_state = check()  
+        # 手臂歸零的同時重設電池倉並讀取初始狀態，連續模式只做一次
+        await run_steps([
+            ("reset", (), lambda: reset_all(3000)),
+            ("storage_reset", (), call_battery_convert_reset),
+            ("status", ("storage_reset",), lambda: report_storage_status("Initial storage status")),
+        ])
 
-        if battery_state:
-            storage()
-            base_position(0.98, 0.98)
-        else:
-            recycle()
-            base_position(0.98, 0.98)
-
-        replace(1.01, 1.07, 25)
+        watch = StopWatch()
+        cycles = 0
+        while True:
+            # 沒確認新車到站就開始，會把剛裝好的電池又拿出來
+            if CONTINUOUS:
+                await wait_for_car()
+            started = watch.time()
+            await cycle()
+            cycles += 1
+            # 每一輪的耗時與連續模式開始後的總時間，PC 端換算每小時的吞吐量
+            send_packet_to_pc(PACKET_TYPE_STATS, ustruct.pack('>HII', cycles % 65536, watch.time() - started, watch.time()))
+            if not CONTINUOUS or not can_continue():
+                break
+            if cycles % REHOME_CYCLES == 0:
+                await rehome_arm()
 
-    process()
+    try:
+        await process()
+    finally:
+        # 中途停止也要存下目前的角度，下次開機才能判斷校正是否還能沿用
+        store_calibration()
+    for line in rpc.report():
+        debug(line)
     debug("___________________")
 
 if __name__ == "__main__":
-    main()
+    run_task(main())
@@ -0,0 +1,97 @@
+from pybricks.tools import wait, StopWatch
+from urandom import randint
+
+# 三台 Hub 共用的 BLE 廣播 RPC。
+# 主控 Hub (手臂) 在自己的頻道廣播 (目標頻道, 序號, 指令)，執行指令的 Hub 在自己的頻道廣播 (序號, 結果) 當作回覆。
+# 同一個序號只會執行一次，所以同一個指令可以連續下兩次；廣播一次最多 26 bytes，指令名稱不要超過 19 個字元。
+# 序號 = 開機時隨機選的 session * 128 + 1~127 的流水號。主控 Hub 重新開機後流水號又從 1 開始，
+# session 不同才不會把其他 Hub 還在廣播的上一次開機的回覆當成這次的回覆。
+# RpcClient 在手臂 Hub 的 run_task 裡使用，等待回覆時不會擋住其他步驟；RpcServer 是一般的同步迴圈。
+
+SEQ_MAX = 127
+SESSION_MAX = 255 # 序號不超過 2 bytes 整數的上限
+
+class RpcClient:
+    def __init__(self, hub):
+        self.hub = hub
+        self.seq = 0
+        self.session = randint(1, SESSION_MAX)
+        self.busy = False
+        self.watch = StopWatch()
+        # 指令 -> [次數, 總延遲 ms, 最大延遲 ms, 重送次數, 逾時次數]
+        self.stats = {}
+
+    async def call(self, target, command, timeout=10000, retry_interval=1000, poll_interval=10):
+        # 送出指令並等待對方回覆相同序號，回傳結果；逾時回傳 None
+        # 一次只能廣播一個指令，同時有其他步驟在等回覆時先排隊
+        while self.busy:
+            await wait(poll_interval)
+        self.busy = True
+        try:
+            return await self.request(target, command, timeout, retry_interval, poll_interval)
+        finally:
+            self.busy = False
+
+    async def request(self, target, command, timeout, retry_interval, poll_interval):
+        self.seq = self.seq % SEQ_MAX + 1
+        message = (target, self.session * (SEQ_MAX + 1) + self.seq, command)
+        await self.hub.ble.broadcast(message)
+        stat = self.stats.get(command)
+        if stat is None:
+            stat = self.stats[command] = [0, 0, 0, 0, 0]
+        started = self.watch.time()
+        last_send = started
+        while self.watch.time() - started < timeout:
+            reply = self.hub.ble.observe(target)
+            if isinstance(reply, tuple) and len(reply) == 2 and reply[0] == message[1]:
+                await self.hub.ble.broadcast(None)
+                elapsed = self.watch.time() - started
+                stat[0] += 1
+                stat[1] += elapsed
+                stat[2] = max(stat[2], elapsed)
+                return reply[1]
+            if self.watch.time() - last_send >= retry_interval:
+                # 對方可能漏掉了這次廣播，重新廣播一次
+                last_send = self.watch.time()
+                stat[3] += 1
+                await self.hub.ble.broadcast(message)
+            await wait(poll_interval)
+        await self.hub.ble.broadcast(None)
+        stat[4] += 1
+        return None
+
+    def report(self):
+        lines = []
+        for command, (count, total, longest, retries, timeouts) in self.stats.items():
+            lines.append(f"{command}: {count} 次 平均 {total // count if count else 0} ms 最大 {longest} ms 重送 {retries} 逾時 {timeouts}")
+        return lines
+
+class RpcServer:
+    def __init__(self, hub, master_id, my_id, handlers):
+        self.hub = hub
+        self.master_id = master_id
+        self.my_id = my_id
+        self.handlers = handlers
+        self.last_seq = None
+
+    def poll(self):
+        # 收訊短暫中斷 (observe 回傳 None) 時不能清掉 last_seq，否則主控 Hub 還在廣播的同一個指令會再執行一次；
+        # 序號含有每次開機不同的 session，重新開機後的指令不會和 last_seq 相同
+        request = self.hub.ble.observe(self.master_id)
+        if not isinstance(request, tuple) or len(request) != 3 or request[0] != self.my_id:
+            return
+        _, seq, command = request
+        # 主控 Hub 在收到回覆前會一直廣播同一個指令，已經執行過的不再執行，回覆仍在廣播中
+        if seq == self.last_seq:
+            return
+        handler = self.handlers.get(command)
+        if handler is None:
+            return
+        result = handler()
+        self.last_seq = seq
+        self.hub.ble.broadcast((seq, True if result is None else result))
+
+    def serve(self, poll_interval=10):
+        while True:
+            self.poll()
+            wait(poll_interval)
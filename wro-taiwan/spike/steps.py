@@ -0,0 +1,23 @@
+from pybricks.tools import multitask, wait
+
+# 手臂 Hub 的步驟排程，在 run_task 裡使用。
+# 每個步驟是 (名稱, 要先完成的步驟, 回傳協程的函式)，沒有相依關係的步驟由 multitask 同時執行，
+# 例如手臂移動的同時等待電池倉轉盤的回覆。用到同一顆馬達的步驟一定要宣告相依，否則會同時對同一顆馬達下指令。
+
+async def run_steps(steps, poll_interval=5):
+    names = [name for name, _, _ in steps]
+    for name, after, _ in steps:
+        for dependency in after:
+            if dependency not in names:
+                raise ValueError(f"步驟 {name} 相依的 {dependency} 不存在")
+    results = {}
+
+    async def run_step(name, after, step):
+        for dependency in after:
+            while dependency not in results:
+                await wait(poll_interval)
+        results[name] = await step()
+
+    # 任一步驟出錯 (例如 SystemExit) 時 multitask 會取消其他步驟
+    await multitask(*[run_step(name, after, step) for name, after, step in steps])
+    return results
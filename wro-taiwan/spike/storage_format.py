@@ -0,0 +1,39 @@
+# 電池倉狀態的二進位格式，一次 RPC 回覆就能送完:
+# [格式版本, 槽位數, 槽位 0 有無電池, 槽位 0 電量, 槽位 1 有無電池, ...]，槽位順序固定為 SLOTS。
+# 前三個槽位的排列和傳給 PC 的 storage 封包 (>BBBBBB) 相同，手臂 Hub 收到後直接複製過去。
+# 之後增加槽位時接在後面即可，一次廣播最多放得下 MAX_SLOTS 個。
+
+STORAGE_FORMAT_VERSION = 1
+SLOTS = ("BLUE", "RED", "GREEN")
+HEADER_SIZE = 2
+MAX_SLOTS = 10
+# 電量到這個值以上的電池才會拿去換給車子
+USABLE_CHARGE = 90
+
+def encode_storage(slots):
+    # slots: 依 SLOTS 順序的 [有無電池, 電量]
+    data = bytearray(HEADER_SIZE + 2 * len(slots))
+    data[0] = STORAGE_FORMAT_VERSION
+    data[1] = len(slots)
+    for i, (has_battery, charge) in enumerate(slots):
+        data[HEADER_SIZE + 2 * i] = has_battery
+        data[HEADER_SIZE + 2 * i + 1] = charge
+    return bytes(data)
+
+def slot_count(data):
+    # 格式版本或長度不對時回傳 0
+    if not isinstance(data, bytes) or len(data) < HEADER_SIZE or data[0] != STORAGE_FORMAT_VERSION:
+        return 0
+    if len(data) < HEADER_SIZE + 2 * data[1]:
+        return 0
+    return data[1]
+
+def find_slot(data, has_battery, min_charge=0):
+    # 回傳第一個符合的槽位索引，找不到回傳 -1
+    for i in range(slot_count(data)):
+        if data[HEADER_SIZE + 2 * i] == has_battery and data[HEADER_SIZE + 2 * i + 1] >= min_charge:
+            return i
+    return -1
+
+def describe_storage(data):
+    return " ".join(f"{SLOTS[i] if i < len(SLOTS) else i}={data[HEADER_SIZE + 2 * i]}/{data[HEADER_SIZE + 2 * i + 1]}" for i in range(slot_count(data)))
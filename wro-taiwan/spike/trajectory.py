@@ -0,0 +1,40 @@
+from pybricks.tools import wait
+
+# 多顆馬達同步移動到指定姿勢，在 run_task 裡使用。
+# 以最慢到達的那顆馬達 (距離 / 速度上限) 決定移動時間，其他馬達依距離等比例降速，所有馬達同時到達。
+# 常用的姿勢在開機時用 add_pose 登記成表，目標角度與速度上限只算一次，移動時只需要依目前角度算速度。
+
+MIN_SPEED = 10 # deg/s，距離很短時避免速度太小
+
+class Trajectory:
+    def __init__(self, limits):
+        # limits: ((馬達, 速度上限 deg/s), ...)
+        self.limits = limits
+        self.poses = {}
+
+    def limit(self, motor):
+        for limited, speed in self.limits:
+            if limited is motor:
+                return speed
+        raise ValueError("馬達沒有設定速度上限")
+
+    def add_pose(self, name, targets):
+        # targets: ((馬達, 目標角度), ...)
+        self.poses[name] = tuple((motor, target, self.limit(motor)) for motor, target in targets)
+
+    async def move(self, name):
+        await self.move_to(self.poses[name])
+
+    async def move_to(self, pose):
+        duration = 0
+        for motor, target, limit in pose:
+            duration = max(duration, abs(target - motor.angle()) / limit)
+        if duration == 0:
+            return
+        for motor, target, limit in pose:
+            distance = abs(target - motor.angle())
+            if distance:
+                motor.run_target(max(MIN_SPEED, distance / duration), target, wait = False)
+        for motor, _, _ in pose:
+            while not motor.done():
+                await wait(10)